@@ -0,0 +1,233 @@
+"""Implements count tables, the per token results of aggregating hits
+that graphs are drawn from, and a persistent cache of them, so redrawing
+graphs of csvs that did not change does not need to read the csvs again"""
+import os
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+
+import token_table
+
+# Part of every definition id, increase it if count tables change,
+# so outdated cached count tables are not used anymore
+COUNT_TABLE_VERSION = 1
+NANOSECONDS_PER_MINUTE = 60 * 10**9
+
+
+def get_definition_id(kind, column):
+    """Stable identifier of what a count table counts: "category" counts hits
+    per value of a column, "time" counts hits per minute of a timestamp
+    column. Graph definitions that count the same column share it"""
+    return f"{kind}:{column}:v{COUNT_TABLE_VERSION}"
+
+
+class CountTable:
+    """The number of hits of a single token per category of some columns, and
+    per minute of some timestamp columns, together with the first and last
+    timestamp. Minutes nest into all TIME_BUCKETS of analysis, so every
+    bucket size can be counted from them. Count tables of the same token can
+    be merged, e.g. to add the counts of hits appended to its csv"""
+
+    def __init__(self):
+        # column -> {category: number of hits}
+        self.category_counts = {}
+        # column -> {minute since epoch: number of hits}
+        self.minute_counts = {}
+        # column -> (first, last) timestamp in nanoseconds, None without hits
+        self.time_ranges = {}
+
+    @classmethod
+    def from_table(cls, table, category_columns=(), time_columns=()):
+        """Counts a table as returned by token_table.load_token_table,
+        adding derived columns to it if they are counted"""
+        if any(column not in table.columns for column in category_columns):
+            token_table.add_derived_columns(table)
+        count_table = cls()
+        for column in category_columns:
+            value_counts = table[column].value_counts(sort=False)
+            count_table.category_counts[column] = {category: int(count)
+                    for category, count in zip(value_counts.index.tolist(), value_counts.to_numpy())
+                    if count > 0}
+        for column in time_columns:
+            timestamps = table[column].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+            minutes, counts = np.unique(timestamps // NANOSECONDS_PER_MINUTE, return_counts=True)
+            count_table.minute_counts[column] = dict(zip(minutes.tolist(), counts.tolist()))
+            count_table.time_ranges[column] = None if len(timestamps) == 0 else \
+                    (int(timestamps.min()), int(timestamps.max()))
+        return count_table
+
+    def covers(self, category_columns=(), time_columns=()):
+        return (all(column in self.category_counts for column in category_columns)
+                and all(column in self.minute_counts for column in time_columns))
+
+    def merge(self, other):
+        """Adds the counts of other to the counts of this count table, for
+        columns both count. Other columns are taken over. Returns self"""
+        for own_counts, other_counts in ((self.category_counts, other.category_counts),
+                (self.minute_counts, other.minute_counts)):
+            for column, counts in other_counts.items():
+                if column not in own_counts:
+                    own_counts[column] = dict(counts)
+                    continue
+                merged_counts = own_counts[column]
+                for key, count in counts.items():
+                    merged_counts[key] = merged_counts.get(key, 0) + count
+
+        for column, time_range in other.time_ranges.items():
+            own_range = self.time_ranges.get(column)
+            if own_range is None:
+                self.time_ranges[column] = time_range
+            elif time_range is not None:
+                self.time_ranges[column] = (min(own_range[0], time_range[0]),
+                        max(own_range[1], time_range[1]))
+        return self
+
+    def get_minute_counts(self, column):
+        """Returns minutes since epoch and the number of hits in them as arrays"""
+        counts = self.minute_counts[column]
+        return (np.fromiter(counts.keys(), dtype=np.int64, count=len(counts)),
+                np.fromiter(counts.values(), dtype=np.int64, count=len(counts)))
+
+    def to_json(self, kind, column):
+        """Serializes the counts of a single definition, see get_definition_id"""
+        if kind == "category":
+            # As pairs, json keys would turn categories like True into strings
+            return json.dumps(list(self.category_counts[column].items()), ensure_ascii=False)
+        return json.dumps({"minute_counts": list(self.minute_counts[column].items()),
+            "time_range": self.time_ranges[column]})
+
+    def load_json(self, kind, column, text):
+        """Adds the counts of a single definition, as serialized by to_json"""
+        counts = json.loads(text)
+        if kind == "category":
+            self.category_counts[column] = dict((category, count) for category, count in counts)
+            return
+        self.minute_counts[column] = dict((minute, count)
+                for minute, count in counts["minute_counts"])
+        self.time_ranges[column] = None if counts["time_range"] is None else \
+                tuple(counts["time_range"])
+
+
+def hash_file(path, prefix_size=None):
+    """Returns the sha256 hex digest of the file at path, and that of its
+    first prefix_size bytes, computed in the same pass. The latter is None
+    without prefix_size"""
+    file_hash = hashlib.sha256()
+    prefix_hash = None
+    with open(path, "rb") as file_to_hash:
+        if prefix_size is not None:
+            remaining_size = prefix_size
+            while remaining_size > 0:
+                block = file_to_hash.read(min(1 << 16, remaining_size))
+                if len(block) == 0:
+                    break
+                file_hash.update(block)
+                remaining_size -= len(block)
+            if remaining_size == 0:
+                prefix_hash = file_hash.hexdigest()
+        for block in iter(lambda: file_to_hash.read(1 << 16), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest(), prefix_hash
+
+
+class AggregationCache:
+    """Persistent cache of count tables, stored in a sqlite file. Counts are
+    keyed by the sha256 of the file they were counted from and the
+    definition id (see get_definition_id) of what was counted.
+    For every source path the size, mtime and hash it had when it was last
+    counted are kept. Files whose size and mtime did not change are not hashed
+    again, and if hits were only appended to a csv since, just the new rows
+    are read and their counts merged into the cached ones.
+    Counts hits, appends and misses, so callers can report how effective it was"""
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.appends = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sources ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+                "content_hash TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS count_tables ("
+                "content_hash TEXT NOT NULL, definition_id TEXT NOT NULL, "
+                "counts TEXT NOT NULL, PRIMARY KEY (content_hash, definition_id))")
+        self.connection.commit()
+
+    def get_count_table(self, filename, category_columns=(), time_columns=(),
+            binary_format=None):
+        """Returns the CountTable of the token file (csv or binary, see
+        token_table.load_token_table) for the given columns, from the cache
+        if possible, and caches it otherwise"""
+        definitions = [("category", column) for column in category_columns] + \
+                [("time", column) for column in time_columns]
+        stat = os.stat(filename)
+        source = self.connection.execute(
+                "SELECT size, mtime, content_hash FROM sources WHERE path = ?",
+                (os.path.abspath(filename),)).fetchone()
+
+        if source is not None and (source[0], source[1]) == (stat.st_size, stat.st_mtime):
+            content_hash, prefix_hash = source[2], None
+        else:
+            prefix_size = None
+            if source is not None and source[0] < stat.st_size and filename.endswith(".csv"):
+                prefix_size = source[0]
+            content_hash, prefix_hash = hash_file(filename, prefix_size)
+
+        count_table = self._load_count_table(content_hash, definitions)
+        if count_table is not None:
+            self.hits += 1
+        else:
+            columns = list(dict.fromkeys(list(category_columns) + list(time_columns)))
+            if prefix_hash is not None and prefix_hash == source[2]:
+                count_table = self._load_count_table(source[2], definitions)
+            if count_table is not None:
+                # Only count the appended rows
+                self.appends += 1
+                appended_table = token_table.load_token_table_tail(filename, source[0], columns)
+                count_table.merge(CountTable.from_table(appended_table,
+                    category_columns, time_columns))
+            else:
+                self.misses += 1
+                count_table = CountTable.from_table(token_table.load_token_table(
+                    filename, columns, binary_format), category_columns, time_columns)
+            self.connection.executemany("INSERT OR REPLACE INTO count_tables "
+                    "(content_hash, definition_id, counts) VALUES (?, ?, ?)",
+                    [(content_hash, get_definition_id(kind, column),
+                        count_table.to_json(kind, column)) for kind, column in definitions])
+
+        self._update_source(os.path.abspath(filename), stat, content_hash,
+                None if source is None else source[2])
+        self.connection.commit()
+        return count_table
+
+    def _load_count_table(self, content_hash, definitions):
+        """Returns the cached CountTable of all definitions,
+        or None if any of them is not cached"""
+        count_table = CountTable()
+        for kind, column in definitions:
+            row = self.connection.execute(
+                    "SELECT counts FROM count_tables WHERE content_hash = ? AND definition_id = ?",
+                    (content_hash, get_definition_id(kind, column))).fetchone()
+            if row is None:
+                return None
+            count_table.load_json(kind, column, row[0])
+        return count_table
+
+    def _update_source(self, path, stat, content_hash, previous_content_hash):
+        self.connection.execute("INSERT OR REPLACE INTO sources (path, size, mtime, content_hash) "
+                "VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime, content_hash))
+        if previous_content_hash is None or previous_content_hash == content_hash:
+            return
+        # Drop counts of content no source has anymore
+        still_used = self.connection.execute("SELECT 1 FROM sources WHERE content_hash = ?",
+                (previous_content_hash,)).fetchone()
+        if still_used is None:
+            self.connection.execute("DELETE FROM count_tables WHERE content_hash = ?",
+                    (previous_content_hash,))
+
+    def close(self):
+        self.connection.close()
@@ -1,24 +1,66 @@
 """Implements a class and functions to simplify
 drawing of graphs analysing token hits"""
-import json
+import os
+import re
+import math
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from user_agents import parse
+from matplotlib.figure import Figure
+
+import token_table
+from aggregation_cache import CountTable, NANOSECONDS_PER_MINUTE
+
+# Rows and columns of subplots in a figure
+DEFAULT_GRID = (2, 3)
+# Size of a single subplot, in inches, for figures rendered to files
+SUBPLOT_SIZE = (5, 4)
+# Name of the figure with all tokens, no token figure gets this name
+ALL_TOKENS_FIGURE_NAME = "all_tokens"
+
+# Bucket sizes for column based over time graphs. With "auto" the smallest
+# bucket size that splits the time span of all hits into at most
+# MAX_AUTO_BUCKETS buckets is used, days if none does
+TIME_BUCKETS = {"minute": pd.Timedelta(minutes=1), "hour": pd.Timedelta(hours=1),
+        "day": pd.Timedelta(days=1)}
+MAX_AUTO_BUCKETS = 1000
 
 class TokenToGraph:
     """Represents a single token, which usually corresponds to a csv
     file. Contains the token hits, as well as meta information
     that AnalysisGraph uses. A TokenToGraph is passed to 
     AnalysisGraph which illustrates it.
+    The hits are either a list of TokenHits, or a table as returned
+    by token_table.load_token_table. For a table, tokenhits
+    contains one row object per hit, created on first access.
+    Graph definitions that read columns are drawn from a count_table,
+    which AnalysisGraph counts from the hits if none is given, e.g. by
+    aggregation_cache.AggregationCache. Without hits, only such graph
+    definitions can be drawn.
     """
 
-    def __init__(self, title, list_of_all_tokenhits):
+    def __init__(self, title, list_of_all_tokenhits=None, table=None, count_table=None):
         self.title = title
-        self.tokenhits = list_of_all_tokenhits
+        self._table = table
+        self._tokenhits = list_of_all_tokenhits
+        self.count_table = count_table
+
+    @property
+    def tokenhits(self):
+        if self._tokenhits is None:
+            # Rows have the same attributes as TokenHits
+            self._tokenhits = list(self.table.itertuples(index=False, name="TokenHitRow"))
+        return self._tokenhits
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = token_table.table_from_token_hits(self._tokenhits)
+        return self._table
 
 
 
@@ -33,9 +75,21 @@ class AnalysisGraph:
     relative to each other
     sort_function is usually the same as extraction_algorithm, but since
     internally we use a unix uniq-style function this needs to create an order
-    that is equivalent (or at least compatible) with the extraction_algorithm)"""
-
-    def __init__(self):
+    that is equivalent (or at least compatible) with the extraction_algorithm)
+    Instead of an extraction_algorithm, graphs can group by a column of the
+    token tables, e.g. one of token_table.DERIVED_COLUMNS. category_labels
+    optionally maps column values to the names shown in the graph.
+    This is much faster than calling a lambda for every hit: the counts of all
+    column based definitions are computed together, for all tokens at once,
+    by _aggregate_column_definitions.
+    Column based over time graphs count hits per time bucket (see
+    TIME_BUCKETS), as a running total with time_view="cumulative", or per
+    bucket with time_view="rate". If max_points is set and there are more
+    buckets, neighbouring buckets are merged, keeping their maximum rate so
+    peaks stay visible, or the running total at the last of them.
+    "{bucket}" in the graph name is replaced by the bucket size"""
+
+    def __init__(self, time_bucket="auto", max_points=None):
         # TODO accept multiple graphs, as list
         # TODO update function doc
         self.graph_names = []
@@ -44,9 +98,18 @@ class AnalysisGraph:
 
         self.data_source_list = []
         self.sort_functions = []
+        self.columns = []
+        self.category_labels = []
+        self.time_views = []
+        # Maps graph definition index to dataframe, see _aggregate_column_definitions
+        self._aggregated_dataframes = None
 
+        self.time_bucket = time_bucket
+        self.max_points = max_points
 
-    def add_graph_definition(self, graph_name, extraction_algorithm, over_time=False, sort_function=None):
+
+    def add_graph_definition(self, graph_name, extraction_algorithm=None, over_time=False,
+            sort_function=None, column=None, category_labels=None, time_view="cumulative"):
         self.graph_names.append(graph_name)
         self.extraction_algorithms.append(extraction_algorithm)
         self.over_times.append(over_time)
@@ -55,56 +118,126 @@ class AnalysisGraph:
             sort_function = extraction_algorithm
 
         self.sort_functions.append(sort_function)
+        self.columns.append(column)
+        self.category_labels.append(category_labels)
+        self.time_views.append(time_view)
+        self._aggregated_dataframes = None
+
+    def get_required_columns(self):
+        """Returns the table columns needed to draw all graph definitions,
+        or None if all columns are needed because of extraction algorithms"""
+        if any(column is None for column in self.columns):
+            return None
+        # The time span of the hits decides the time bucket size
+        required_columns = ["timestamp"]
+        for column in self.columns:
+            if column not in required_columns:
+                required_columns.append(column)
+        return required_columns
+
+    def get_counted_columns(self):
+        """Returns the (category columns, time columns) that count tables
+        need to contain to draw all column based graph definitions"""
+        category_columns = []
+        time_columns = []
+        for column, over_time in zip(self.columns, self.over_times):
+            counted_columns = time_columns if over_time else category_columns
+            if column is not None and column not in counted_columns:
+                counted_columns.append(column)
+        return category_columns, time_columns
 
     def set_data_sources(self, list_of_TokenToGraphs):
         self.data_source_list = (list_of_TokenToGraphs)
+        self._aggregated_dataframes = None
 
 
 
-    def draw(self):
+    def draw(self, grid=DEFAULT_GRID):
         """Draws this AnalysisGraph and pops up the finished graph. Expects
         a list of TokenToGraphs, which contain TokenHits as defined in main.py"""
-        # TODO DOCS
         fig= plt.figure()
-        sns.set_theme()
-        legend_names = []
-        list_of_TokenToGraphs = self.data_source_list
-        for token_to_graph in list_of_TokenToGraphs:
-            legend_names.append(token_to_graph.title)
-
-
-        for graph_definition_index in range(len(self.graph_names)):
-            ax = fig.add_subplot(2,3, graph_definition_index+1)
-            plt.title(self.graph_names[graph_definition_index])
-            plt.xticks(rotation=45)
-
-            if self.over_times[graph_definition_index]:
-                plot = self._draw_continuous_plot(list_of_TokenToGraphs, graph_definition_index, ax)
-            else:
-                plot = self._draw_category_plot(list_of_TokenToGraphs, graph_definition_index, ax)
-            ax.get_legend().remove()
-
-
-        # legend is implicit and discouraged, but it's fine
-        plt.figlegend(legend_names, loc='lower right',bbox_to_anchor=(0.85,0.25))
+        draw_plot_frames(fig, self.get_plot_frames(), self._get_legend_names(), grid)
         plt.show()
 
-    def _draw_continuous_plot(self, list_of_all_tokens, graph_definition_index,ax):
-        # TODO doc
-        token_dataframe = self._construct_dataframe_for_seaborn(list_of_all_tokens, graph_definition_index)
-        return sns.scatterplot(x='Category', y='Value', hue='Token name', data=token_dataframe, ax=ax)
-
-    def _draw_category_plot(self, list_of_all_tokens, graph_definition_index, ax):
-        # TODO doc
-        # Apply the extraction function to the list of all tokens
-        token_dataframe = self._construct_dataframe_for_seaborn(list_of_all_tokens, graph_definition_index)
-        return sns.barplot(x='Category', y='Value', hue='Token name', data=token_dataframe, ax=ax)
+    def render_to_files(self, output_dir, formats=("png",), dpi=100, grid=DEFAULT_GRID,
+            workers=1, separate_graphs=False, changed_titles=None):
+        """Renders this AnalysisGraph to files in output_dir instead of popping
+        it up: all_tokens contains all tokens, and every token gets a figure of
+        its own, named like its csv (see get_figure_names). With
+        separate_graphs every graph is written to its own file. If
+        changed_titles is given, only the figures of tokens with these
+        titles are rendered again, besides all_tokens.
+        Figures are rendered in a process pool if workers > 1.
+        Returns the paths of all written files"""
+        os.makedirs(output_dir, exist_ok=True)
+        plot_frames = self.get_plot_frames()
+
+        figures = [(ALL_TOKENS_FIGURE_NAME, plot_frames, self._get_legend_names())]
+        # Named before skipping unchanged tokens, so names don't depend on what changed
+        figure_names = get_figure_names([token_to_graph.title
+            for token_to_graph in self.data_source_list])
+        for token_to_graph, figure_name in zip(self.data_source_list, figure_names):
+            if changed_titles is not None and token_to_graph.title not in changed_titles:
+                continue
+            token_plot_frames = [(graph_name, plot_kind,
+                token_dataframe[token_dataframe['Token name'] == token_to_graph.title])
+                for graph_name, plot_kind, token_dataframe in plot_frames]
+            figures.append((figure_name, token_plot_frames,
+                [token_to_graph.title]))
+
+        figure_jobs = []
+        for figure_name, figure_plot_frames, legend_names in figures:
+            if not separate_graphs:
+                figure_jobs.append((os.path.join(output_dir, figure_name),
+                    figure_plot_frames, legend_names, grid, formats, dpi))
+                continue
+            for single_plot_frame in figure_plot_frames:
+                figure_jobs.append((os.path.join(output_dir,
+                    figure_name + "_" + get_figure_name(single_plot_frame[0])),
+                    [single_plot_frame], legend_names, (1, 1), formats, dpi))
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                written_paths = list(executor.map(render_figure_to_files, figure_jobs))
+        else:
+            written_paths = list(map(render_figure_to_files, figure_jobs))
+        return [path for paths_of_figure in written_paths for path in paths_of_figure]
+
+    def get_plot_frames(self):
+        """Returns a (graph name, plot kind, dataframe) tuple for every graph
+        definition, with the dataframes as returned by
+        _construct_dataframe_for_seaborn for all data sources.
+        The plot kind is one of bar, scatter or line"""
+        plot_frames = []
+        bucket_name = self._get_time_bucket_name(self.data_source_list)
+        for graph_definition_index, graph_name in enumerate(self.graph_names):
+            if not self.over_times[graph_definition_index]:
+                plot_kind = "bar"
+            elif self.columns[graph_definition_index] is None:
+                plot_kind = "scatter"
+            else:
+                plot_kind = "line"
+            plot_frames.append((graph_name.replace("{bucket}", bucket_name), plot_kind,
+                self._construct_dataframe_for_seaborn(self.data_source_list, graph_definition_index)))
+        return plot_frames
 
+    def _get_legend_names(self):
+        return [token_to_graph.title for token_to_graph in self.data_source_list]
 
     def _construct_dataframe_for_seaborn(self, tokens_list, graph_definition_index):
         # TODO
         """ [category, token name, value],
         [category, token name, value]"""
+        if (self.columns[graph_definition_index] is not None
+                and not self.over_times[graph_definition_index]):
+            if tokens_list is not self.data_source_list:
+                return self._aggregate_column_definitions(tokens_list)[graph_definition_index]
+            if self._aggregated_dataframes is None:
+                self._aggregated_dataframes = self._aggregate_column_definitions(tokens_list)
+            return self._aggregated_dataframes[graph_definition_index]
+        if self.columns[graph_definition_index] is not None:
+            return self._aggregate_time_definition(tokens_list, graph_definition_index)
+
         category_list = []
         token_name_list = []
         value_list = []
@@ -123,11 +256,152 @@ class AnalysisGraph:
         return token_dataframe
 
 
+    def _aggregate_column_definitions(self, tokens_list):
+        """Aggregation engine for all column based, non over time graph
+        definitions. Stacks the count tables of all tokens and pivots them
+        into a (token, category) matrix with one vectorized pass per column,
+        definitions that share a column share the counts.
+        Returns a dict that maps graph definition index to a dataframe as
+        returned by _construct_dataframe_for_seaborn, ordered by token,
+        then by category"""
+        token_names = np.array([token.title for token in tokens_list], dtype=object)
+        count_tables = [self._get_count_table(token) for token in tokens_list]
+
+        counts_by_column = {}
+        aggregated_dataframes = {}
+        for graph_definition_index, column in enumerate(self.columns):
+            if column is None or self.over_times[graph_definition_index]:
+                continue
+            if column not in counts_by_column:
+                counts_by_column[column] = self._count_column(count_tables, column)
+            categories, counts = counts_by_column[column]
+
+            category_labels = self.category_labels[graph_definition_index] or {}
+            shown_categories = np.array([category_labels.get(category, category)
+                for category in categories], dtype=object)
+            order = sorted(range(len(shown_categories)), key=shown_categories.__getitem__)
+            shown_categories = shown_categories[order]
+            ordered_counts = counts[:, order]
+
+            token_indices, category_indices = np.nonzero(ordered_counts)
+            aggregated_dataframes[graph_definition_index] = pd.DataFrame({
+                'Category': shown_categories[category_indices],
+                'Token name': token_names[token_indices],
+                'Value': ordered_counts[token_indices, category_indices]})
+        return aggregated_dataframes
+
+    def _get_count_table(self, token_to_graph):
+        """Returns the count table of a token, counting its hits first
+        if it has none, or one that lacks counted columns"""
+        category_columns, time_columns = self.get_counted_columns()
+        if token_to_graph.count_table is None:
+            token_to_graph.count_table = CountTable.from_table(token_to_graph.table,
+                    category_columns, time_columns)
+        elif not token_to_graph.count_table.covers(category_columns, time_columns):
+            token_to_graph.count_table.merge(CountTable.from_table(token_to_graph.table,
+                [column for column in category_columns
+                    if column not in token_to_graph.count_table.category_counts],
+                [column for column in time_columns
+                    if column not in token_to_graph.count_table.minute_counts]))
+        return token_to_graph.count_table
+
+    def _count_column(self, count_tables, column):
+        """Returns (categories, counts) of a column over all tokens, where
+        counts is a (token, category) matrix of the number of hits. The
+        counts of all tokens are stacked into a single (token, category)
+        indexed series, which is pivoted into the matrix in one pass"""
+        if len(count_tables) == 0:
+            return (np.empty(0, dtype=object), np.zeros((0, 0), dtype=np.int64))
+        stacked_counts = pd.concat([pd.Series(count_table.category_counts[column],
+            dtype=np.int64) for count_table in count_tables], keys=range(len(count_tables)))
+        category_codes, categories = pd.factorize(stacked_counts.index.get_level_values(1))
+
+        counts = np.zeros((len(count_tables), len(categories)), dtype=np.int64)
+        counts[stacked_counts.index.get_level_values(0), category_codes] = stacked_counts.to_numpy()
+        return (np.asarray(categories, dtype=object), counts)
+
+    def _get_time_bucket_name(self, tokens_list):
+        """Name of the bucket size in TIME_BUCKETS used for these tokens"""
+        if self.time_bucket != "auto":
+            return self.time_bucket
+
+        time_ranges = self._get_time_ranges(tokens_list, "timestamp")
+        if len(time_ranges) == 0:
+            return "day"
+        time_span = pd.Timedelta(max(last for _, last in time_ranges)
+                - min(first for first, _ in time_ranges))
+        for bucket_name, bucket_size in TIME_BUCKETS.items():
+            if time_span / bucket_size <= MAX_AUTO_BUCKETS:
+                return bucket_name
+        return "day"
+
+    def _get_time_ranges(self, tokens_list, column):
+        """Returns the (first, last) timestamp in nanoseconds
+        of all tokens with hits"""
+        if column not in self.get_counted_columns()[1]:
+            # Only graph definitions with extraction algorithms
+            timestamps_of_tokens = [token_to_graph.table[column] for token_to_graph in tokens_list]
+            return [(timestamps.min().value, timestamps.max().value)
+                    for timestamps in timestamps_of_tokens if len(timestamps) > 0]
+        time_ranges = [self._get_count_table(token_to_graph).time_ranges[column]
+                for token_to_graph in tokens_list]
+        return [time_range for time_range in time_ranges if time_range is not None]
+
+    def _aggregate_time_definition(self, tokens_list, graph_definition_index):
+        """Counts the hits of every token per time bucket, with buckets
+        shared by all tokens, from the per minute counts of their count
+        tables. Returns a dataframe as returned by
+        _construct_dataframe_for_seaborn, with the start of the bucket
+        as category, ordered by token, then by time"""
+        column = self.columns[graph_definition_index]
+        bucket_size = TIME_BUCKETS[self._get_time_bucket_name(tokens_list)]
+        time_ranges = self._get_time_ranges(tokens_list, column)
+        if len(time_ranges) == 0:
+            return pd.DataFrame({'Category': [], 'Token name': [], 'Value': []})
+
+        first_bucket = pd.Timestamp(min(first for first, _ in time_ranges)).floor(bucket_size)
+        last_time = pd.Timestamp(max(last for _, last in time_ranges))
+        number_of_buckets = (last_time - first_bucket) // bucket_size + 1
+        bucket_starts = pd.date_range(first_bucket, periods=number_of_buckets, freq=bucket_size)
+
+        token_dataframes = []
+        for token_to_graph in tokens_list:
+            minutes, minute_counts = self._get_count_table(token_to_graph).get_minute_counts(column)
+            # Buckets are whole minutes, so all hits of a minute share a bucket
+            bucket_indices = (minutes * NANOSECONDS_PER_MINUTE - first_bucket.value) // bucket_size.value
+            counts = np.bincount(bucket_indices, weights=minute_counts,
+                    minlength=number_of_buckets).astype(np.int64)
+            if self.time_views[graph_definition_index] == "cumulative":
+                counts = np.cumsum(counts)
+            token_bucket_starts, counts = self._downsample_keeping_peaks(bucket_starts, counts,
+                    self.time_views[graph_definition_index])
+            token_dataframes.append(pd.DataFrame({'Category': token_bucket_starts,
+                'Token name': token_to_graph.title, 'Value': counts}))
+        return pd.concat(token_dataframes, ignore_index=True)
+
+    def _downsample_keeping_peaks(self, bucket_starts, counts, time_view):
+        """Merges groups of neighbouring buckets so at most max_points remain.
+        For the rate view each group is shown at its first bucket with its
+        maximum count, for the cumulative view at its last bucket with the
+        running total there"""
+        if self.max_points is None or len(counts) <= self.max_points:
+            return bucket_starts, counts
+        group_size = math.ceil(len(counts) / self.max_points)
+        if time_view == "cumulative":
+            last_indices = np.append(np.arange(group_size - 1, len(counts) - 1, group_size),
+                    len(counts) - 1)
+            return bucket_starts[last_indices], counts[last_indices]
+        padded_counts = np.zeros(math.ceil(len(counts) / group_size) * group_size, dtype=counts.dtype)
+        padded_counts[:len(counts)] = counts
+        return (bucket_starts[::group_size],
+                padded_counts.reshape(-1, group_size).max(axis=1))
+
     def _get_datapoint_tuples_from_TokenToGraph(self, token_to_graph, graph_definition_index):
-        # TODO 
+        """Slow path for graph definitions with an extraction_algorithm, which
+        is called for every hit. Does not change the order of the tokens hits"""
         datapoint_tuples = []
-        list_of_all_tokenhits = token_to_graph.tokenhits
-        list_of_all_tokenhits.sort(key=self.sort_functions[graph_definition_index])
+        list_of_all_tokenhits = sorted(token_to_graph.tokenhits,
+                key=self.sort_functions[graph_definition_index])
         if self.over_times[graph_definition_index]:
             # "buckets" for this are "this is the nth request",
             # so all buckets have size 1. This information is not contained
@@ -147,14 +421,103 @@ class AnalysisGraph:
 
 
 
+def get_figure_name(title):
+    """Turns a token or graph title into something usable as filename,
+    e.g. path/to/webpage.csv into webpage"""
+    title = os.path.splitext(os.path.basename(title))[0]
+    return re.sub(r"[^\w.-]+", "_", title.lower()).strip("_")
+
+
+def get_figure_names(titles):
+    """Returns a figure name for every token title, like get_figure_name,
+    but unique and other than all_tokens: titles that would get the same
+    name, e.g. csvs with the same name in different folders, get _2, _3, ...
+    appended in the order they are given"""
+    used_names = {ALL_TOKENS_FIGURE_NAME}
+    figure_names = []
+    for title in titles:
+        figure_name = get_figure_name(title)
+        unique_figure_name = figure_name
+        number = 2
+        while unique_figure_name in used_names:
+            unique_figure_name = f"{figure_name}_{number}"
+            number += 1
+        used_names.add(unique_figure_name)
+        figure_names.append(unique_figure_name)
+    return figure_names
+
+
+def get_grid_shape(grid, number_of_graphs):
+    """(rows, columns) of grid, extended by rows if it has
+    fewer cells than there are graphs"""
+    rows, columns = grid
+    return (max(rows, math.ceil(number_of_graphs / columns)), columns)
+
+
+def _draw_continuous_plot(token_dataframe, ax):
+    return sns.scatterplot(x='Category', y='Value', hue='Token name', data=token_dataframe, ax=ax)
+
+
+def _draw_category_plot(token_dataframe, ax):
+    return sns.barplot(x='Category', y='Value', hue='Token name', data=token_dataframe, ax=ax)
+
+
+def _draw_line_plot(token_dataframe, ax):
+    return sns.lineplot(x='Category', y='Value', hue='Token name', data=token_dataframe, ax=ax,
+            errorbar=None)
+
+
+def draw_plot_frames(fig, plot_frames, legend_names, grid=DEFAULT_GRID):
+    """Draws plot frames as returned by AnalysisGraph.get_plot_frames
+    as subplots of fig, see get_grid_shape"""
+    sns.set_theme()
+    rows, columns = get_grid_shape(grid, len(plot_frames))
+
+    for position, (graph_name, plot_kind, token_dataframe) in enumerate(plot_frames):
+        ax = fig.add_subplot(rows, columns, position + 1)
+        ax.set_title(graph_name)
+        ax.tick_params(axis='x', labelrotation=45)
+
+        if plot_kind == "scatter":
+            _draw_continuous_plot(token_dataframe, ax)
+        elif plot_kind == "line":
+            _draw_line_plot(token_dataframe, ax)
+        else:
+            _draw_category_plot(token_dataframe, ax)
+        if ax.get_legend() is not None:
+            ax.get_legend().remove()
+
+    # legend is implicit and discouraged, but it's fine
+    fig.legend(legend_names, loc='lower right',bbox_to_anchor=(0.85,0.25))
+
+
+def render_figure_to_files(figure_job):
+    """Renders a single figure to a file for each format, without pyplot,
+    so no display is needed. Runs in worker processes, so figure_job only
+    contains plain data: (path without extension, plot frames,
+    legend names, grid, formats, dpi). Returns the paths of written files"""
+    figure_path, plot_frames, legend_names, grid, formats, dpi = figure_job
+    sns.set_theme()
+    rows, columns = get_grid_shape(grid, len(plot_frames))
+    fig = Figure(figsize=(columns * SUBPLOT_SIZE[0], rows * SUBPLOT_SIZE[1]))
+
+    draw_plot_frames(fig, plot_frames, legend_names, (rows, columns))
+    fig.tight_layout()
+    written_paths = []
+    for file_format in formats:
+        written_paths.append(f"{figure_path}.{file_format}")
+        fig.savefig(written_paths[-1], format=file_format, dpi=dpi)
+    return written_paths
+
+
 def build_graphs_over_time(graph):
     """Returns a list of all time-relative graphs
     we want to draw.
     """
-    graph.add_graph_definition("Requests over time",
-                lambda hit, position : (hit.timestamp, position),
-                over_time=True,
-                sort_function=lambda hit:hit.timestamp)
+    graph.add_graph_definition("Requests over time", column="timestamp",
+                over_time=True, time_view="cumulative")
+    graph.add_graph_definition("Requests per {bucket}", column="timestamp",
+                over_time=True, time_view="rate")
     return graph
 
 
@@ -162,31 +525,39 @@ def build_graphs_over_all(graph):
     """Returns a list of all graphs
     we want to draw that analyse all hits by some metric
     """
-    graph.add_graph_definition("Requests by country",
-        lambda hit: json.loads(hit.geo_info)["country"])
+    graph.add_graph_definition("Requests by country", column="country")
 
-    graph.add_graph_definition("Requests by Region",
-        lambda hit: json.loads(hit.geo_info)["region"])
+    graph.add_graph_definition("Requests by Region", column="region")
 
-    graph.add_graph_definition("Requests by browser family",
-        lambda hit: parse(hit.useragent).browser.family)
+    graph.add_graph_definition("Requests by browser family", column="browser_family")
 
-    graph.add_graph_definition("Requests by os",
-        lambda hit: parse(hit.useragent).os.family)
+    graph.add_graph_definition("Requests by os", column="os_family")
 
-    graph.add_graph_definition("Requests by mobile devices",
-        lambda hit: "Mobile" if parse(hit.useragent).is_mobile else "PC")
+    graph.add_graph_definition("Requests by mobile devices", column="is_mobile",
+        category_labels={True: "Mobile", False: "PC"})
     return graph
 
 
-def run_analyses(list_of_all_tokensToGraph):
-    """Draws all graphs defined in build_graphs_over_time
-    and build_graphs_over_all"""
-    # TODO Docs
-    graph = AnalysisGraph()
+def build_default_graph(time_bucket="auto", max_points=None):
+    """Returns an AnalysisGraph with all graphs defined in
+    build_graphs_over_time and build_graphs_over_all"""
+    graph = AnalysisGraph(time_bucket, max_points)
     build_graphs_over_time(graph)
     build_graphs_over_all(graph)
+    return graph
 
-    
+
+def run_analyses(list_of_all_tokensToGraph, output_dir=None, formats=("png",), dpi=100,
+        grid=DEFAULT_GRID, workers=1, separate_graphs=False, time_bucket="auto",
+        max_points=None, changed_titles=None):
+    """Draws all graphs defined in build_graphs_over_time
+    and build_graphs_over_all. If an output_dir is given the graphs are
+    rendered to files there, see AnalysisGraph.render_to_files, and the
+    paths of these files are returned"""
+    graph = build_default_graph(time_bucket, max_points)
     graph.set_data_sources(list_of_all_tokensToGraph)
-    graph.draw()
+    if output_dir is not None:
+        return graph.render_to_files(output_dir, formats, dpi, grid, workers, separate_graphs,
+                changed_titles)
+    graph.draw(grid)
+    return []
@@ -0,0 +1,153 @@
+"""Checks that the commands of main.py only import what they need: --help,
+parsing emails and lookups must not import pandas, the plotting stack or
+BeautifulSoup, and must take a fraction of the import time of everything.
+Every command runs in a fresh interpreter with -X importtime, ingestion runs
+use a few synthetic emails and the stub servers. Exits with status 1 if a
+check fails, so it can guard against regressions.
+
+Example call:
+python benchmarks/check_import_time.py --max_ratio 0.5
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_FOLDER = os.path.dirname(BENCHMARK_FOLDER)
+sys.path.insert(0, REPOSITORY_FOLDER)
+
+from generators import generate_hits, write_email_folder
+from stub_servers import StubServer
+
+# Only the visualization step may import these
+HEAVY_MODULES = ["numpy", "pandas", "matplotlib", "seaborn", "user_agents", "bs4", "pyarrow"]
+# Only steps doing lookups may import these
+LOOKUP_MODULES = ["requests"]
+# What importing everything costs, the reference for --max_ratio
+ALL_MODULES = ["main", "analysis", "token_table", "aggregation_cache", "bs4", "requests"]
+NUMBER_OF_EMAILS = 20
+
+# Runs main.main with the arguments given to the interpreter,
+# pointed at the stub servers if STUB_URL is set
+COMMAND_CODE = """
+import os, sys
+sys.path.insert(0, os.environ["REPOSITORY_FOLDER"])
+import main
+stub_url = os.environ.get("STUB_URL")
+if stub_url:
+    main.TokenHitEnrichmentClass.url_of_ipinfo = stub_url + "/{ip}?token={token}"
+    main.TokenHitEnrichmentClass.url_of_ipinfo_batch = stub_url + "/batch?token={token}"
+    main.TokenHitEnrichmentClass.url_of_tor_node_list = stub_url + "/tor"
+try:
+    main.main(sys.argv[1:])
+except SystemExit:
+    pass
+"""
+IMPORT_ALL_CODE = """
+import os, sys
+sys.path.insert(0, os.environ["REPOSITORY_FOLDER"])
+""" + "".join(f"import {module}\n" for module in ALL_MODULES)
+
+
+def measure_imports(code, arguments=(), environment=None, cwd=None):
+    """Runs code in a fresh interpreter with -X importtime. Returns the
+    seconds spent importing and the set of imported top level packages"""
+    environment = dict(os.environ, REPOSITORY_FOLDER=REPOSITORY_FOLDER, **(environment or {}))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code, *arguments],
+            capture_output=True, text=True, env=environment, cwd=cwd, check=True)
+    microseconds = 0
+    packages = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_microseconds, _, name = line[len("import time:"):].split("|")
+        microseconds += int(self_microseconds)
+        packages.add(name.strip().split(".")[0])
+    return microseconds / 10**6, packages
+
+
+def get_cases(work_folder):
+    """Returns (name, arguments, forbidden packages) of every command to check"""
+    email_folder = os.path.join(work_folder, "emails")
+    parsed_prefix = os.path.join(work_folder, "parsed", "")
+    full_prefix = os.path.join(work_folder, "full", "")
+    return [
+        ("--help", ["--help"], HEAVY_MODULES + LOOKUP_MODULES),
+        ("parse --help", ["parse", "--help"], HEAVY_MODULES + LOOKUP_MODULES),
+        ("parse", ["parse", "-if", email_folder, "-p", parsed_prefix],
+            HEAVY_MODULES + LOOKUP_MODULES),
+        ("enrich", ["enrich", "-ic", parsed_prefix + "webpage.csv", "-p", parsed_prefix],
+            HEAVY_MODULES),
+        ("--no_visualize", ["-if", email_folder, "-p", full_prefix, "-nv"], HEAVY_MODULES)]
+
+
+def check_time_bucket_and_format_names():
+    """main spells out the keys of analysis.TIME_BUCKETS and
+    token_table.BINARY_FORMATS, and the file formats of matplotlib,
+    returns the ones that differ"""
+    import main
+    import analysis
+    import token_table
+    failures = []
+    if main.TIME_BUCKET_NAMES != list(analysis.TIME_BUCKETS):
+        failures.append("main.TIME_BUCKET_NAMES differs from analysis.TIME_BUCKETS")
+    if main.BINARY_FORMAT_NAMES != list(token_table.BINARY_FORMATS):
+        failures.append("main.BINARY_FORMAT_NAMES differs from token_table.BINARY_FORMATS")
+    from matplotlib.backend_bases import FigureCanvasBase
+    supported_formats = FigureCanvasBase.get_supported_filetypes()
+    if any(file_format not in supported_formats for file_format in main.GRAPH_FORMAT_NAMES):
+        failures.append("main.GRAPH_FORMAT_NAMES has formats matplotlib can't save")
+    return failures
+
+
+def run_checks(max_ratio=0.5, repeat=3):
+    """Returns a list of failed checks, and prints the import time of every command"""
+    failures = []
+    all_seconds = min(measure_imports(IMPORT_ALL_CODE)[0] for _ in range(repeat))
+    print(f"{'import everything':>18}: {all_seconds:.3f}s", file=sys.stderr)
+
+    hits = generate_hits(NUMBER_OF_EMAILS)
+    with tempfile.TemporaryDirectory() as work_folder, StubServer(hits["src_ip"]) as stub_server:
+        write_email_folder(os.path.join(work_folder, "emails"), hits)
+        for folder in ("parsed", "full"):
+            os.makedirs(os.path.join(work_folder, folder))
+        for name, arguments, forbidden_packages in get_cases(work_folder):
+            timings = []
+            for _ in range(repeat):
+                # The stub servers don't check the api key
+                seconds, packages = measure_imports(COMMAND_CODE, arguments,
+                        {"STUB_URL": stub_server.url, "IPINFO_API_KEY": "import_time_check"},
+                        work_folder)
+                timings.append(seconds)
+            seconds = min(timings)
+            ratio = seconds / all_seconds
+            print(f"{name:>18}: {seconds:.3f}s ({ratio:.0%} of everything)", file=sys.stderr)
+
+            imported_forbidden_packages = sorted(set(forbidden_packages) & packages)
+            if len(imported_forbidden_packages) > 0:
+                failures.append(f"{name} imports {', '.join(imported_forbidden_packages)}")
+            if ratio > max_ratio:
+                failures.append(f"{name} takes {ratio:.0%} of the time of importing "
+                        f"everything, more than {max_ratio:.0%}")
+    return failures + check_time_bucket_and_format_names()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-mr', '--max_ratio', type=float, default=0.5,
+            help='Maximum import time of a command, as share of importing everything')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='Number of runs of every command, the fastest one counts')
+    args = parser.parse_args()
+
+    failures = run_checks(args.max_ratio, args.repeat)
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
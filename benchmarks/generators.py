@@ -0,0 +1,187 @@
+"""Deterministic generators for synthetic token hits, written either as
+canary notification emails or as token csvs. Scanner traffic is very
+skewed, so ips, user agents and reminders are drawn from zipf-like
+distributions: few values make up most hits"""
+import os
+import csv
+import json
+import quopri
+import ipaddress
+
+import numpy as np
+import pandas as pd
+
+CSV_HEADER = ["Timestamp", "src_ip", "input_channel", "geo_info",
+        "is_tor_relay", "referer", "location", "useragent"]
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S (UTC)"
+FIRST_HIT = pd.Timestamp("2023-01-01 00:00:00")
+
+# Exponent of the zipf-like distributions, higher is more skewed
+SKEW = 1.2
+# Share of hits whose Source IP field holds a local and a public ip
+DOUBLE_IP_SHARE = 0.05
+
+REMINDERS = ["webpage", "docs", "backup", "admin_panel", "invoice_pdf",
+        "aws_keys", "wiki", "mailing_list"]
+CHANNELS = ["HTTP", "DNS", "HTTP", "HTTP"]
+COUNTRIES = [("US", "California"), ("US", "Virginia"), ("DE", "Hesse"),
+        ("NL", "North Holland"), ("CN", "Beijing"), ("RU", "Moscow"),
+        ("FR", "Île-de-France"), ("GB", "England"), ("SG", "Singapore"),
+        ("BR", "São Paulo")]
+USERAGENT_TEMPLATES = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/{version}.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (X11; Linux x86_64; rv:{version}.0) Gecko/20100101 Firefox/{version}.0",
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 16_{minor} like Mac OS X) AppleWebKit/605.1.15 "
+        "(KHTML, like Gecko) Version/16.{minor} Mobile/15E148 Safari/604.1",
+        "Mozilla/5.0 (Linux; Android 13; SM-S901B) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/{version}.0.0.0 Mobile Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_{minor}) AppleWebKit/605.1.15 "
+        "(KHTML, like Gecko) Version/16.{minor} Safari/605.1.15",
+        "curl/7.{version}.0",
+        "python-requests/2.{minor}.0",
+        "Go-http-client/1.1",
+        "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+        "Microsoft Office Word 2014"]
+
+EMAIL_TEMPLATE = """From: Canarytokens <noreply@canarytokens.org>
+To: alerts@example.com
+Subject: Canarytoken triggered
+MIME-Version: 1.0
+Content-Type: text/html; charset="utf-8"
+Content-Transfer-Encoding: quoted-printable
+
+{body}"""
+
+HTML_TEMPLATE = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" \
+"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd"><html><head>\
+<meta http-equiv="Content-Type" content="text/html; charset=UTF-8"></head><body>
+<table class="main" width="100%">
+<tr><td class="alert alert-warning">Your Canarytoken was triggered</td></tr>
+<tr><td class="label">Channel</td><td class="value">{channel}</td></tr>
+<tr><td class="label">Time</td><td class="value">{time}</td></tr>
+<tr><td class="label">Canarytoken</td><td class="value">{token_id}</td></tr>
+<tr><td class="label">Token Reminder</td><td class="value">{reminder}</td></tr>
+<tr><td class="label">Token Type</td><td class="value">web</td></tr>
+<tr><td class="label">Source IP</td><td class="value">{src_ip}</td></tr>
+<tr><td class="label">User Agent</td><td class="value">{useragent}</td></tr>
+</table></body></html>
+"""
+
+
+def _zipf_choice(rng, number_of_values, size):
+    """Draws size indices into number_of_values values, index 0 most often"""
+    weights = 1 / np.arange(1, number_of_values + 1) ** SKEW
+    return rng.choice(number_of_values, size=size, p=weights / weights.sum())
+
+
+def get_geo_info(ip):
+    """Deterministic ipinfo-like geo info json for an ip, as the stub server
+    returns it. Private ips are bogons, as on ipinfo"""
+    address = ipaddress.ip_address(ip)
+    if address.is_private:
+        return json.dumps({"ip": ip, "bogon": True})
+    country, region = COUNTRIES[int(address) % len(COUNTRIES)]
+    return json.dumps({"ip": ip, "city": region, "region": region,
+        "country": country}, ensure_ascii=False)
+
+
+def is_tor_exit(ip):
+    """Deterministic part of ips that the stub tor exit list contains"""
+    return int(ipaddress.ip_address(ip)) % 50 == 0
+
+
+def generate_hits(number_of_hits, seed=0):
+    """Returns a DataFrame with the columns timestamp, src_ip, input_channel,
+    useragent and reminder for number_of_hits hits, sorted by time.
+    The same number_of_hits and seed always give the same hits"""
+    rng = np.random.default_rng(seed)
+    number_of_ips = max(10, int(number_of_hits ** 0.6))
+    number_of_useragents = max(10, int(number_of_hits ** 0.4))
+
+    # Public ips, with a few private ones
+    ip_values = rng.integers(int(ipaddress.ip_address("1.0.0.0")),
+            int(ipaddress.ip_address("223.255.255.255")), size=number_of_ips)
+    ips = [str(ipaddress.ip_address(int(value))) for value in ip_values]
+    for index in range(0, number_of_ips, 20):
+        ips[index] = f"192.168.{index // 256 % 256}.{index % 256}"
+
+    useragents = []
+    for index in range(number_of_useragents):
+        template = USERAGENT_TEMPLATES[index % len(USERAGENT_TEMPLATES)]
+        useragents.append(template.format(version=90 + index // len(USERAGENT_TEMPLATES),
+            minor=index % 10))
+
+    # Bursts of scans: exponential gaps, mostly short
+    gaps = rng.exponential(scale=60, size=number_of_hits)
+    gaps[rng.random(number_of_hits) < 0.9] /= 100
+    timestamps = FIRST_HIT + pd.to_timedelta(np.cumsum(gaps).astype("int64"), unit="s")
+
+    return pd.DataFrame({
+        "timestamp": timestamps.strftime(TIMESTAMP_FORMAT),
+        "src_ip": np.array(ips, dtype=object)[_zipf_choice(rng, number_of_ips, number_of_hits)],
+        "input_channel": np.array(CHANNELS, dtype=object)[
+            rng.integers(len(CHANNELS), size=number_of_hits)],
+        "useragent": np.array(useragents, dtype=object)[
+            _zipf_choice(rng, number_of_useragents, number_of_hits)],
+        "reminder": np.array(REMINDERS, dtype=object)[
+            _zipf_choice(rng, len(REMINDERS), number_of_hits)],
+        "double_ip": rng.random(number_of_hits) < DOUBLE_IP_SHARE})
+
+
+def format_canary_email(hit, token_id="synthetic"):
+    """Returns a canary notification email for a row of generate_hits"""
+    src_ip = hit.src_ip
+    if hit.double_ip:
+        src_ip = "10.0.0.1, " + src_ip
+    html = HTML_TEMPLATE.format(channel=hit.input_channel, time=hit.timestamp,
+            token_id=token_id, reminder=hit.reminder, src_ip=src_ip,
+            useragent=hit.useragent.replace("&", "&amp;"))
+    body = quopri.encodestring(html.encode("utf-8")).decode("ascii")
+    return EMAIL_TEMPLATE.format(body=body)
+
+
+def write_email_folder(folder, hits):
+    """Writes one .eml file per hit into folder, returns their paths"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for index, hit in enumerate(hits.itertuples(index=False)):
+        path = os.path.join(folder, f"canary_{index:08d}.eml")
+        with open(path, "w") as email_file:
+            email_file.write(format_canary_email(hit))
+        paths.append(path)
+    return paths
+
+
+def write_mbox(path, hits):
+    """Writes all hits as messages of a single mbox file"""
+    with open(path, "w") as mbox_file:
+        for hit in hits.itertuples(index=False):
+            mbox_file.write("From noreply@canarytokens.org Sun Jan  1 00:00:00 2023\n")
+            mbox_file.write(format_canary_email(hit))
+            mbox_file.write("\n")
+
+
+def write_token_csvs(folder, hits):
+    """Writes hits as token csvs in the format main.py produces, one
+    <reminder>.csv per reminder, with geo info and tor status as the stub
+    servers report them. Returns their paths"""
+    unique_ips = hits["src_ip"].unique()
+    geo_infos = {ip: get_geo_info(ip) for ip in unique_ips}
+    tor_exits = {ip: str(is_tor_exit(ip)) for ip in unique_ips}
+    table = pd.DataFrame({
+        "Timestamp": hits["timestamp"],
+        "src_ip": hits["src_ip"],
+        "input_channel": hits["input_channel"],
+        "geo_info": hits["src_ip"].map(geo_infos),
+        "is_tor_relay": hits["src_ip"].map(tor_exits),
+        "referer": "",
+        "location": "",
+        "useragent": hits["useragent"]})
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for reminder, token_table in table.groupby(hits["reminder"], sort=True):
+        path = os.path.join(folder, reminder + ".csv")
+        token_table.to_csv(path, index=False, quoting=csv.QUOTE_ALL, columns=CSV_HEADER)
+        paths.append(path)
+    return paths
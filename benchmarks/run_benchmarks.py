@@ -0,0 +1,237 @@
+"""Times every stage of the pipeline on synthetic data and writes the
+results as json, so runs on different commits can be compared.
+
+Example calls:
+python benchmarks/run_benchmarks.py --hits 1000 100000 --output results.json
+Times all stages for 1k and 100k hits
+
+python benchmarks/run_benchmarks.py --stages parse enrich --compare results.json
+Times only the email stages and prints how they changed since results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import matplotlib
+# Render off screen
+matplotlib.use("Agg")
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_FOLDER = os.path.dirname(BENCHMARK_FOLDER)
+sys.path.insert(0, REPOSITORY_FOLDER)
+
+import analysis
+import token_table
+from enrichment import GeoCache, TorExitSnapshots
+from generators import (generate_hits, write_email_folder, write_mbox, write_token_csvs)
+from stub_servers import StubServer
+
+STAGES = ["parse", "parse_mbox", "enrich", "create_list_from_csv", "load_token_table",
+        "aggregate", "render"]
+# Email stages only use the first hits, millions of email files are not worth it
+DEFAULT_MAX_EMAILS = 10000
+
+
+def import_main():
+    """Imports main.py, which can't be imported at the top
+    as this script has a main function of its own"""
+    import main
+    return main
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_FOLDER,
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkData:
+    """Generates the emails and csv for a number of hits once,
+    in a folder named after number of hits and seed"""
+
+    def __init__(self, work_dir, number_of_hits, seed, max_emails):
+        self.folder = os.path.join(work_dir, f"hits_{number_of_hits}_seed_{seed}")
+        self.hits = generate_hits(number_of_hits, seed)
+        self.email_hits = self.hits.iloc[:min(number_of_hits, max_emails)]
+        self.email_folder = os.path.join(self.folder, f"emails_{len(self.email_hits)}")
+        self.mbox_path = self.email_folder + ".mbox"
+        self.csv_folder = os.path.join(self.folder, "csvs")
+
+    def get_email_paths(self):
+        if not os.path.isdir(self.email_folder):
+            write_email_folder(self.email_folder + ".tmp", self.email_hits)
+            os.replace(self.email_folder + ".tmp", self.email_folder)
+        return sorted(os.path.join(self.email_folder, name)
+                for name in os.listdir(self.email_folder))
+
+    def get_mbox_path(self):
+        if not os.path.exists(self.mbox_path):
+            write_mbox(self.mbox_path + ".tmp", self.email_hits)
+            os.replace(self.mbox_path + ".tmp", self.mbox_path)
+        return self.mbox_path
+
+    def get_csv_paths(self):
+        if not os.path.isdir(self.csv_folder):
+            write_token_csvs(self.csv_folder + ".tmp", self.hits)
+            os.replace(self.csv_folder + ".tmp", self.csv_folder)
+        return sorted(os.path.join(self.csv_folder, name)
+                for name in os.listdir(self.csv_folder))
+
+
+def run_stage(main, stage, data, stub_server, scratch_folder):
+    """Runs a stage once. Returns (seconds, number of items processed),
+    setup like generating data is not timed"""
+    if stage == "parse":
+        email_paths = data.get_email_paths()
+        start = time.perf_counter()
+        for path in email_paths:
+            with open(path) as email:
+                main.build_token_hit_from_email(email)
+        return time.perf_counter() - start, len(email_paths)
+
+    if stage == "parse_mbox":
+        from email_sources import index_mbox
+        mbox_path = data.get_mbox_path()
+        start = time.perf_counter()
+        email_sources = index_mbox(mbox_path)
+        for _ in main.parse_email_files(email_sources):
+            pass
+        return time.perf_counter() - start, len(email_sources)
+
+    if stage == "enrich":
+        token_hits = []
+        for path in data.get_email_paths():
+            with open(path) as email:
+                token_hits.append(main.build_token_hit_from_email(email)[1])
+        enrichment = main.TokenHitEnrichmentClass
+        enrichment.url_of_ipinfo = stub_server.url + "/{ip}?token={token}"
+        enrichment.url_of_ipinfo_batch = stub_server.url + "/batch?token={token}"
+        enrichment.geo_cache = GeoCache(":memory:")
+        enrichment.geo_resolver = None
+        enrichment.tor_exits = TorExitSnapshots(stub_server.url + "/tor")
+        start = time.perf_counter()
+        main.enrich_token_hits(token_hits)
+        return time.perf_counter() - start, len(token_hits)
+
+    csv_paths = data.get_csv_paths()
+    if stage == "create_list_from_csv":
+        start = time.perf_counter()
+        number_of_hits = sum(len(main.create_list_from_csv(path)) for path in csv_paths)
+        return time.perf_counter() - start, number_of_hits
+
+    if stage == "load_token_table":
+        start = time.perf_counter()
+        number_of_hits = sum(len(token_table.load_token_table(path)) for path in csv_paths)
+        return time.perf_counter() - start, number_of_hits
+
+    graph = analysis.build_default_graph()
+    tokens_to_graph = [analysis.TokenToGraph(path, table=token_table.load_token_table(path,
+        graph.get_required_columns())) for path in csv_paths]
+    if stage == "aggregate":
+        # Includes decoding geo info and user agents
+        start = time.perf_counter()
+        graph.set_data_sources(tokens_to_graph)
+        graph.get_plot_frames()
+        return time.perf_counter() - start, len(data.hits)
+
+    if stage == "render":
+        graph.set_data_sources(tokens_to_graph)
+        output_dir = os.path.join(scratch_folder, "render")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        start = time.perf_counter()
+        graph.render_to_files(output_dir)
+        return time.perf_counter() - start, len(data.hits)
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def run_benchmarks(hit_counts, stages, repeat=3, seed=0, work_dir=None,
+        max_emails=DEFAULT_MAX_EMAILS):
+    """Runs every stage repeat times for every number of hits.
+    Returns the results as json serializable dict"""
+    main = import_main()
+    results = []
+    with tempfile.TemporaryDirectory() as scratch_folder:
+        if work_dir is None:
+            work_dir = scratch_folder
+        for number_of_hits in hit_counts:
+            data = BenchmarkData(work_dir, number_of_hits, seed, max_emails)
+            with StubServer(data.hits["src_ip"]) as stub_server:
+                for stage in stages:
+                    timings = []
+                    for _ in range(repeat):
+                        seconds, number_of_items = run_stage(main, stage, data,
+                                stub_server, scratch_folder)
+                        timings.append(seconds)
+                    best_seconds = min(timings)
+                    results.append({"stage": stage, "hits": number_of_hits,
+                        "items": number_of_items, "seconds": timings,
+                        "best_seconds": best_seconds,
+                        "median_seconds": statistics.median(timings),
+                        "items_per_second": number_of_items / best_seconds
+                            if best_seconds > 0 else None})
+                    print(f"{stage:>22} {number_of_hits:>9} hits: {number_of_items:>9} items "
+                            f"in {best_seconds:.3f}s (best of {repeat})", file=sys.stderr)
+    return {"commit": get_commit(), "python": platform.python_version(),
+            "platform": platform.platform(), "seed": seed, "repeat": repeat,
+            "max_emails": max_emails, "results": results}
+
+
+def compare_results(previous, current):
+    """Prints the change in best time of every stage and number of hits
+    that both result dicts contain"""
+    previous_seconds = {(result["stage"], result["hits"]): result["best_seconds"]
+            for result in previous["results"]}
+    print(f"Compared to {previous.get('commit')}:", file=sys.stderr)
+    for result in current["results"]:
+        key = (result["stage"], result["hits"])
+        if key not in previous_seconds or previous_seconds[key] == 0:
+            continue
+        change = result["best_seconds"] / previous_seconds[key] - 1
+        print(f"{result['stage']:>22} {result['hits']:>9} hits: {change:+.1%}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--hits', type=int, nargs='+', default=[1000, 100000],
+            help='Numbers of hits to benchmark, e.g. 1000 1000000')
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=STAGES,
+            help='Stages to benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='Number of runs of every stage, the best one counts')
+    parser.add_argument('--seed', type=int, default=0,
+            help='Seed of the synthetic data')
+    parser.add_argument('-me', '--max_emails', type=int, default=DEFAULT_MAX_EMAILS,
+            help='Email stages use at most this many hits')
+    parser.add_argument('-wd', '--work_dir',
+            help='Keep generated data in this folder, so later runs reuse it')
+    parser.add_argument('-o', '--output',
+            help='Write the results to this json file instead of stdout')
+    parser.add_argument('-c', '--compare',
+            help='Results json of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.hits, args.stages, args.repeat, args.seed,
+            args.work_dir, args.max_emails)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            compare_results(json.load(previous_file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Local stand-ins for ipinfo.io and the tor exit list, so the enrichment
+stage can be benchmarked without network access or an api key. Answers
+come from generators.get_geo_info and generators.is_tor_exit"""
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from generators import get_geo_info, is_tor_exit
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """GET /tor returns the tor exit list, GET /<ip> the geo info of
+    an ip, and POST /batch the geo infos of a json list of ips. The first
+    rate_limited_requests requests are answered with HTTP 429 instead"""
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean
+        pass
+
+    def _send(self, body, content_type="application/json", status=200, headers=()):
+        encoded_body = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def _send_rate_limited(self):
+        """Answers with HTTP 429 if requests are still rate limited"""
+        with self.server.lock:
+            self.server.requests_served += 1
+            if self.server.rate_limited_requests == 0:
+                return False
+            self.server.rate_limited_requests -= 1
+        headers = []
+        if self.server.retry_after is not None:
+            headers.append(("Retry-After", self.server.retry_after))
+        self._send(json.dumps({"status": 429, "error": {"title": "Rate limit exceeded"}}),
+                status=429, headers=headers)
+        return True
+
+    def do_GET(self):
+        if self._send_rate_limited():
+            return
+        path = self.path.split("?")[0].strip("/")
+        if path == "tor":
+            self._send("\n".join(self.server.tor_exit_ips) + "\n", "text/plain")
+            return
+        geo_info = get_geo_info(path)
+        if self.server.pretty:
+            # Like ipinfo.io answers single lookups
+            geo_info = json.dumps(json.loads(geo_info), indent=2, ensure_ascii=False)
+        self._send(geo_info)
+
+    def do_POST(self):
+        if self._send_rate_limited():
+            return
+        content_length = int(self.headers["Content-Length"])
+        ips = json.loads(self.rfile.read(content_length))
+        self._send(json.dumps({ip: json.loads(get_geo_info(ip)) for ip in ips},
+            ensure_ascii=False))
+
+
+class StubServer:
+    """Serves StubRequestHandler on a free local port in a background thread.
+    tor_exit_ips are the ips of the generated hits that is_tor_exit selects.
+    The first rate_limited_requests requests get HTTP 429, with retry_after
+    as Retry-After header if it is given. With pretty single geo info
+    lookups are answered pretty printed, batch lookups are always compact"""
+
+    def __init__(self, ips=(), rate_limited_requests=0, retry_after=None, pretty=False):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubRequestHandler)
+        self.server.tor_exit_ips = sorted(ip for ip in set(ips) if is_tor_exit(ip))
+        self.server.requests_served = 0
+        self.server.rate_limited_requests = rate_limited_requests
+        self.server.retry_after = retry_after
+        self.server.pretty = pretty
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    @property
+    def requests_served(self):
+        return self.server.requests_served
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,213 @@
+"""Implements the places emails can be read from: loose .eml files,
+Maildir folders and mbox files. Every email is represented by a small,
+picklable source object, so lists of them can be split across worker
+processes, which then read the email themselves"""
+import os
+import mmap
+import hashlib
+from collections import Counter
+
+# Start of the separator line in front of every message of an mbox file
+MBOX_SEPARATOR = b"\nFrom "
+
+# Memory maps of mbox files opened in this process, by path
+_open_mbox_maps = {}
+
+
+class EmailFile:
+    """An email stored in a file of its own"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def key(self):
+        """Identifies this email in the manifest of processed emails"""
+        return self.path
+
+    def get_size(self):
+        return os.path.getsize(self.path)
+
+    def get_mtime(self):
+        return os.path.getmtime(self.path)
+
+    def read_bytes(self):
+        with open(self.path, "rb") as email_file:
+            return email_file.read()
+
+    def get_sha256(self):
+        """Returns the sha256 hex digest of the content of this email"""
+        return hashlib.sha256(self.read_bytes()).hexdigest()
+
+
+class MaildirMessage(EmailFile):
+    """A message of a Maildir. Mail clients move messages from new to cur
+    and add flags to their file name, so it is identified by the unique
+    part of its file name instead of its path"""
+
+    def __init__(self, path, maildir_path):
+        super().__init__(path)
+        self.maildir_path = maildir_path
+
+    @property
+    def key(self):
+        unique_name = os.path.basename(self.path).split(":")[0]
+        return os.path.join(self.maildir_path, unique_name)
+
+
+class MboxMessage:
+    """A message within an mbox file, without its separator line,
+    given by its byte offsets. Read through a memory map of the mbox
+    file that is shared by all messages read in the same process.
+    Offsets shift whenever a message in front is removed, so it is
+    identified by the hash of its content instead, and by how many
+    messages with the same content come before it"""
+
+    def __init__(self, mbox_path, start, end, sha256, occurrence=1):
+        self.mbox_path = mbox_path
+        self.start = start
+        self.end = end
+        self.sha256 = sha256
+        self.occurrence = occurrence
+
+    @property
+    def key(self):
+        return f"{self.mbox_path}#{self.sha256}-{self.occurrence}"
+
+    def get_size(self):
+        return self.end - self.start
+
+    def get_mtime(self):
+        # The mtime of the mbox changes with every new message,
+        # so it says nothing about this message
+        return None
+
+    def read_bytes(self):
+        return _get_mbox_map(self.mbox_path)[self.start:self.end]
+
+    def get_sha256(self):
+        # Hashed once already, by index_mbox
+        return self.sha256
+
+
+def _get_mbox_map(mbox_path):
+    if mbox_path not in _open_mbox_maps:
+        with open(mbox_path, "rb") as mbox_file:
+            _open_mbox_maps[mbox_path] = mmap.mmap(mbox_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+    return _open_mbox_maps[mbox_path]
+
+
+def list_email_files(path_to_email_folder):
+    """Returns an EmailFile for every file in the email folder, sorted by path"""
+    return [EmailFile(path) for path in sorted(entry.path
+        for entry in os.scandir(path_to_email_folder) if entry.is_file())]
+
+
+def list_maildir_messages(path_to_maildir):
+    """Returns a MaildirMessage for every message in the new and cur
+    folders of a Maildir, sorted by path"""
+    messages = []
+    for subfolder in ("cur", "new"):
+        subfolder_path = os.path.join(path_to_maildir, subfolder)
+        if os.path.isdir(subfolder_path):
+            messages.extend(MaildirMessage(email_file.path, path_to_maildir)
+                    for email_file in list_email_files(subfolder_path))
+    return messages
+
+
+class MboxIndex:
+    """The messages of an mbox file, kept between calls of update(). If the
+    same file only grew since, e.g. because new mail was delivered to it,
+    only the messages from the last known one on are indexed and hashed
+    again. Otherwise, e.g. after messages were removed, it is indexed anew"""
+
+    def __init__(self, mbox_path):
+        self.mbox_path = mbox_path
+        self._stat = None
+        self._reset()
+
+    def _reset(self):
+        self.messages = []
+        self._occurrences = Counter()
+        # Start of the separator line of the last message
+        self._last_separator_start = 0
+
+    def update(self):
+        """Indexes what changed since the last update, returns all messages
+        in order. Only scans the memory-mapped file for separator lines and
+        hashes the messages, they are parsed later, by whichever process
+        gets them"""
+        stat = os.stat(self.mbox_path)
+        if self._stat is not None and (stat.st_ino, stat.st_size, stat.st_mtime_ns) == \
+                (self._stat.st_ino, self._stat.st_size, self._stat.st_mtime_ns):
+            return list(self.messages)
+        if self.mbox_path in _open_mbox_maps and \
+                len(_open_mbox_maps[self.mbox_path]) != stat.st_size:
+            # Messages were appended or removed since it was mapped
+            _open_mbox_maps.pop(self.mbox_path).close()
+        if stat.st_size == 0:
+            self._reset()
+            self._stat = stat
+            return []
+        mbox_map = _get_mbox_map(self.mbox_path)
+
+        if self._was_appended_to(stat, mbox_map):
+            # The last message may have grown, so it is indexed again
+            last_message = self.messages.pop()
+            self._occurrences[last_message.sha256] -= 1
+            separator_starts = [self._last_separator_start]
+        else:
+            self._reset()
+            # Anything in front of the first separator line is not a message
+            separator_starts = [0] if mbox_map[:5] == MBOX_SEPARATOR[1:] else []
+        self._stat = stat
+
+        position = mbox_map.find(MBOX_SEPARATOR, separator_starts[-1] if separator_starts else 0)
+        while position != -1:
+            separator_starts.append(position + 1)
+            position = mbox_map.find(MBOX_SEPARATOR, position + 1)
+
+        message_ends = separator_starts[1:] + [len(mbox_map)]
+        for separator_start, message_end in zip(separator_starts, message_ends):
+            message_start = mbox_map.find(b"\n", separator_start, message_end) + 1
+            if message_start > 0:
+                digest = hashlib.sha256(mbox_map[message_start:message_end]).hexdigest()
+                self._occurrences[digest] += 1
+                self.messages.append(MboxMessage(self.mbox_path, message_start, message_end,
+                    digest, self._occurrences[digest]))
+                self._last_separator_start = separator_start
+        return list(self.messages)
+
+    def _was_appended_to(self, stat, mbox_map):
+        """Whether the file is the same one and only grew, judged by its
+        first message and the separator line of its last one"""
+        if self._stat is None or len(self.messages) == 0 or \
+                stat.st_ino != self._stat.st_ino or stat.st_size <= self._stat.st_size:
+            return False
+        first_message = self.messages[0]
+        if mbox_map[self._last_separator_start:self._last_separator_start + 5] != \
+                MBOX_SEPARATOR[1:]:
+            return False
+        return hashlib.sha256(mbox_map[first_message.start:first_message.end]).hexdigest() \
+                == first_message.sha256
+
+
+def index_mbox(mbox_path):
+    """Returns an MboxMessage for every message in an mbox file, in order,
+    see MboxIndex"""
+    return MboxIndex(mbox_path).update()
+
+
+def list_email_sources(input_folder=None, input_mbox=None, input_maildir=None):
+    """Returns the email sources of all given inputs, in this order:
+    the files of the email folder, the messages of the mbox file
+    and the messages of the Maildir"""
+    email_sources = []
+    if input_folder is not None:
+        email_sources.extend(list_email_files(input_folder))
+    if input_mbox is not None:
+        email_sources.extend(index_mbox(input_mbox))
+    if input_maildir is not None:
+        email_sources.extend(list_maildir_messages(input_maildir))
+    return email_sources
@@ -0,0 +1,406 @@
+"""Implements lookups that enrich token hits with data that is
+not contained within the canary emails themselves"""
+import os
+import csv
+import json
+import bisect
+import sqlite3
+import time
+import logging
+import ipaddress
+from array import array
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
+
+# ipinfo data rarely changes, so cached entries stay valid for a while
+DEFAULT_GEO_CACHE_TTL_DAYS = 30
+# The tor exit list is regenerated roughly every hour
+DEFAULT_TOR_SNAPSHOT_MAX_AGE_HOURS = 6
+
+
+class GeoCache:
+    """Persistent cache of geo info lookups, keyed by ip and stored
+    in a sqlite file. Entries older than ttl_seconds are treated as missing,
+    pass None to keep them forever. Independent of the sqlite file
+    every ip is looked up at most once per run.
+    Counts hits and misses, so callers can report how effective it was"""
+
+    def __init__(self, path, ttl_seconds=DEFAULT_GEO_CACHE_TTL_DAYS * 24 * 60 * 60):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._run_cache = {}
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS geo_info ("
+                "ip TEXT PRIMARY KEY, geo_info TEXT NOT NULL, fetched_at REAL NOT NULL)")
+        self.connection.commit()
+
+    def get(self, ip):
+        """Returns the cached geo info for this ip, or None
+        if it is not cached or has expired"""
+        ip = str(ip)
+        if ip in self._run_cache:
+            self.hits += 1
+            return self._run_cache[ip]
+
+        row = self.connection.execute(
+                "SELECT geo_info, fetched_at FROM geo_info WHERE ip = ?", (ip,)).fetchone()
+        if row is not None and (self.ttl_seconds is None
+                or time.time() - row[1] <= self.ttl_seconds):
+            self.hits += 1
+            self._run_cache[ip] = row[0]
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, ip, geo_info):
+        """Stores geo info for this ip. Committed immediately, so
+        lookups are not lost if the run is interrupted"""
+        ip = str(ip)
+        self._run_cache[ip] = geo_info
+        self.connection.execute(
+                "INSERT OR REPLACE INTO geo_info (ip, geo_info, fetched_at) VALUES (?, ?, ?)",
+                (ip, geo_info, time.time()))
+        self.connection.commit()
+
+    def put_many(self, geo_infos):
+        """Stores geo info for all (ip, geo_info) pairs in a single transaction"""
+        fetched_at = time.time()
+        rows = []
+        for ip, geo_info in geo_infos:
+            self._run_cache[str(ip)] = geo_info
+            rows.append((str(ip), geo_info, fetched_at))
+        self.connection.executemany(
+                "INSERT OR REPLACE INTO geo_info (ip, geo_info, fetched_at) VALUES (?, ?, ?)",
+                rows)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def format_ipinfo_json(ipinfo_object):
+    """Formats a parsed ipinfo response the way the single ip endpoint
+    returns it (pretty printed with two spaces), with newlines removed
+    as they are in the csv"""
+    return json.dumps(ipinfo_object, indent=2, ensure_ascii=False).replace("\n", "")
+
+
+class IpinfoResolver:
+    """Resolves geo info for many ips at once over a pooled session.
+    Uses the ipinfo batch endpoint if a batch url is given, and looks up
+    everything the batch did not answer concurrently, with at most
+    max_concurrency requests in flight. Requests answered with HTTP 429
+    are retried with exponential backoff.
+    Urls are format strings as in TokenHitEnrichmentClass, so this can be
+    pointed at a local server"""
+    batch_size = 1000
+
+    def __init__(self, url_of_ipinfo, api_key, url_of_ipinfo_batch=None,
+            max_concurrency=8, max_retries=5, backoff_seconds=1.0, timeout_seconds=30):
+        self.url_of_ipinfo = url_of_ipinfo
+        self.url_of_ipinfo_batch = url_of_ipinfo_batch
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.requests_sent = 0
+
+        # Imported here, so runs without lookups don't pay for it
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def resolve(self, ips):
+        """Returns a dict that maps each ip to a (geo_info, ok) tuple.
+        geo_info is the response text as written to the csv, ok is False
+        if the lookup failed and geo_info contains the error response, or an
+        error in the same format if the request itself failed"""
+        results = {}
+        ips = [str(ip) for ip in ips]
+        if self.url_of_ipinfo_batch is not None:
+            for start in range(0, len(ips), self.batch_size):
+                results.update(self._resolve_batch(ips[start:start + self.batch_size]))
+
+        missing_ips = [ip for ip in ips if ip not in results]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results.update(zip(missing_ips, executor.map(self._resolve_single, missing_ips)))
+        return results
+
+    def _resolve_batch(self, ips):
+        """Looks up all ips in a single request. Returns only the ips that
+        were answered successfully, failures are left to the single lookups"""
+        import requests
+        logging.info("Getting geo info for %d ips in a batch", len(ips))
+        try:
+            response = self._request_with_backoff("POST",
+                    self.url_of_ipinfo_batch.format(token=self.api_key), json=ips)
+            if not response.ok:
+                logging.info("Batch lookup failed with HTTP %d", response.status_code)
+                return {}
+            answers = response.json()
+        except (requests.RequestException, ValueError) as error:
+            logging.info("Batch lookup failed: %s", error)
+            return {}
+
+        results = {}
+        for ip in ips:
+            answer = answers.get(ip)
+            if isinstance(answer, dict) and "error" not in answer:
+                results[ip] = (format_ipinfo_json(answer), True)
+        return results
+
+    def _resolve_single(self, ip):
+        import requests
+        logging.info(f"Getting geo info for {ip}")
+        try:
+            response = self._request_with_backoff("GET",
+                    self.url_of_ipinfo.format(ip=ip, token=self.api_key))
+        except requests.RequestException as error:
+            # Like an error response, so the other lookups still finish
+            logging.info("Lookup of %s failed: %s", ip, error)
+            return (json.dumps({"error": {"title": "Lookup failed", "message": str(error)}}),
+                    False)
+        return (response.text.replace("\n", ""), response.ok)
+
+    def _request_with_backoff(self, method, url, **kwargs):
+        delay = self.backoff_seconds
+        for attempt in range(self.max_retries + 1):
+            self.requests_sent += 1
+            response = self.session.request(method, url,
+                    timeout=self.timeout_seconds, **kwargs)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            time.sleep(float(retry_after) if retry_after.isdigit() else delay)
+            delay *= 2
+        return response
+
+
+def normalize_ip(ip):
+    """Returns ip, which may be a string, as ipaddress object.
+    IPv4 addresses mapped into IPv6 are returned as IPv4 address"""
+    ip = ipaddress.ip_address(str(ip).strip())
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        return ip.ipv4_mapped
+    return ip
+
+
+def parse_tor_exit_list(text):
+    """Returns the set of ips in a torbulkexitlist"""
+    exit_ips = set()
+    for line in text.splitlines():
+        try:
+            exit_ips.add(normalize_ip(line))
+        except ValueError:
+            # Empty lines or comments
+            continue
+    return exit_ips
+
+
+class TorExitSnapshots:
+    """Tor exit lists, each a set of ips together with the unix time it was
+    fetched at. If a snapshot_folder is given snapshots are stored there
+    as torbulkexitlist_<fetch time>.txt, and the newest one is reused instead
+    of downloading a new list as long as it is younger than max_age_seconds.
+    With load_history all stored snapshots are loaded, and each ip is
+    checked against the snapshot closest to the time of its hit.
+    Snapshots are loaded on first use"""
+    snapshot_filename_prefix = "torbulkexitlist_"
+
+    def __init__(self, url_of_tor_node_list, snapshot_folder=None,
+            max_age_seconds=DEFAULT_TOR_SNAPSHOT_MAX_AGE_HOURS * 60 * 60,
+            load_history=False):
+        self.url_of_tor_node_list = url_of_tor_node_list
+        self.snapshot_folder = snapshot_folder
+        self.max_age_seconds = max_age_seconds
+        self.load_history = load_history
+
+        # Both sorted by fetch time
+        self.fetch_times = []
+        self.snapshots = []
+        self.downloads = 0
+
+    def is_tor_exit(self, ip, timestamp=None):
+        """Checks whether ip is in the tor exit list closest to timestamp,
+        a naive datetime in UTC. Without timestamp the newest list is used"""
+        if len(self.snapshots) == 0:
+            self._load()
+        return normalize_ip(ip) in self._get_closest_snapshot(timestamp)
+
+    def expire_outdated(self):
+        """Drops the loaded exit lists if the newest one is older than
+        max_age_seconds, so the next check loads them again and downloads
+        a new one. For processes that run longer than that"""
+        if len(self.fetch_times) > 0 and time.time() - self.fetch_times[-1] > self.max_age_seconds:
+            self.fetch_times = []
+            self.snapshots = []
+
+    def _get_closest_snapshot(self, timestamp):
+        if timestamp is None or len(self.snapshots) == 1:
+            return self.snapshots[-1]
+
+        hit_time = timestamp.replace(tzinfo=timezone.utc).timestamp()
+        index = bisect.bisect_left(self.fetch_times, hit_time)
+        if index == 0:
+            return self.snapshots[0]
+        if index == len(self.snapshots):
+            return self.snapshots[-1]
+        if hit_time - self.fetch_times[index - 1] <= self.fetch_times[index] - hit_time:
+            return self.snapshots[index - 1]
+        return self.snapshots[index]
+
+    def _get_stored_snapshot_paths(self):
+        """Returns (fetch time, path) of all stored snapshots, sorted by fetch time"""
+        if self.snapshot_folder is None or not os.path.isdir(self.snapshot_folder):
+            return []
+        stored_snapshots = []
+        for entry in os.scandir(self.snapshot_folder):
+            name, extension = os.path.splitext(entry.name)
+            if not name.startswith(self.snapshot_filename_prefix) or extension != ".txt":
+                continue
+            try:
+                fetch_time = float(name[len(self.snapshot_filename_prefix):])
+            except ValueError:
+                continue
+            stored_snapshots.append((fetch_time, entry.path))
+        return sorted(stored_snapshots)
+
+    def _download_snapshot(self):
+        import requests
+        logging.info("Getting list of tor nodes from %s", self.url_of_tor_node_list)
+        self.downloads += 1
+        response = requests.get(self.url_of_tor_node_list, timeout=30)
+        response.raise_for_status()
+        fetch_time = time.time()
+        if self.snapshot_folder is not None:
+            os.makedirs(self.snapshot_folder, exist_ok=True)
+            snapshot_path = os.path.join(self.snapshot_folder,
+                    f"{self.snapshot_filename_prefix}{int(fetch_time)}.txt")
+            with open(snapshot_path, "w") as snapshot_file:
+                snapshot_file.write(response.text)
+        return fetch_time, response.text
+
+    def _load(self):
+        import requests
+        stored_snapshots = self._get_stored_snapshot_paths()
+        if not self.load_history:
+            stored_snapshots = stored_snapshots[-1:]
+
+        for fetch_time, snapshot_path in stored_snapshots:
+            logging.info("Using stored tor exit list %s", snapshot_path)
+            with open(snapshot_path) as snapshot_file:
+                self.fetch_times.append(fetch_time)
+                self.snapshots.append(parse_tor_exit_list(snapshot_file.read()))
+
+        if len(self.fetch_times) == 0 or time.time() - self.fetch_times[-1] > self.max_age_seconds:
+            try:
+                fetch_time, text = self._download_snapshot()
+            except requests.RequestException:
+                if len(self.snapshots) == 0:
+                    raise
+                logging.warning("Could not get a new tor exit list, using the stored one")
+                return
+            if not self.load_history:
+                self.fetch_times = []
+                self.snapshots = []
+            self.fetch_times.append(fetch_time)
+            self.snapshots.append(parse_tor_exit_list(text))
+
+
+class GeoDatabase:
+    """Offline replacement for ipinfo lookups, backed by a local ip range
+    database. Either an MMDB file (e.g. GeoLite2 City or the ipinfo
+    country database), which is memory-mapped and needs the maxminddb
+    package, or a csv with the columns start_ip, end_ip, country, region.
+    Ranges from a csv are kept in sorted integer arrays per ip version
+    and looked up with a binary search.
+    Lookups return geo info strings in the shape ipinfo returns them"""
+
+    def __init__(self, path):
+        self.path = path
+        self._mmdb_reader = None
+        if path.endswith(".mmdb"):
+            self._open_mmdb()
+        else:
+            self._load_csv()
+
+    def _open_mmdb(self):
+        try:
+            import maxminddb
+        except ImportError as error:
+            raise ImportError("Reading .mmdb geo databases requires the maxminddb package") from error
+        self._mmdb_reader = maxminddb.open_database(self.path, maxminddb.MODE_MMAP)
+
+    def _load_csv(self):
+        ranges = {4: [], 6: []}
+        locations = []
+        location_indices = {}
+        with open(self.path, newline="") as csv_file:
+            for row in csv.DictReader(csv_file):
+                start = normalize_ip(row["start_ip"])
+                end = normalize_ip(row["end_ip"])
+                location = (row.get("country", ""), row.get("region", ""))
+                if location not in location_indices:
+                    location_indices[location] = len(locations)
+                    locations.append(location)
+                ranges[start.version].append((int(start), int(end), location_indices[location]))
+
+        self.locations = locations
+        # IPv6 addresses don't fit into an array, so those stay python ints
+        self.range_starts = {4: array("I"), 6: []}
+        self.range_ends = {4: array("I"), 6: []}
+        self.range_locations = {4: array("I"), 6: array("I")}
+        for version, ranges_of_version in ranges.items():
+            ranges_of_version.sort()
+            for start, end, location_index in ranges_of_version:
+                self.range_starts[version].append(start)
+                self.range_ends[version].append(end)
+                self.range_locations[version].append(location_index)
+
+    def _lookup_location(self, ip):
+        """Returns (country, region) for the ip, or None if it is not contained"""
+        if self._mmdb_reader is not None:
+            record = self._mmdb_reader.get(str(ip))
+            if record is None:
+                return None
+            country = record.get("country")
+            if isinstance(country, dict):
+                # GeoLite2 layout
+                country = country.get("iso_code")
+            region = record.get("region")
+            subdivisions = record.get("subdivisions")
+            if region is None and subdivisions:
+                region = subdivisions[0].get("names", {}).get("en")
+            return (country, region)
+
+        index = bisect.bisect_right(self.range_starts[ip.version], int(ip)) - 1
+        if index < 0 or int(ip) > self.range_ends[ip.version][index]:
+            return None
+        return self.locations[self.range_locations[ip.version][index]]
+
+    def get_geo_info(self, ip):
+        """Returns the geo info for this ip as json string, with the keys
+        ipinfo uses. Keys that are unknown for this ip are left out"""
+        ip = normalize_ip(ip)
+        geo_info = {"ip": str(ip)}
+        if ip.is_private:
+            # As ipinfo reports them
+            geo_info["bogon"] = True
+            return format_ipinfo_json(geo_info)
+
+        location = self._lookup_location(ip)
+        if location is not None:
+            country, region = location
+            if region:
+                geo_info["region"] = region
+            if country:
+                geo_info["country"] = country
+        return format_ipinfo_json(geo_info)
@@ -0,0 +1,254 @@
+"""Implements the hit store, which keeps the hits of all token files in a
+local, column wise and indexed form, so graphs of a time window or a subset
+of hits (e.g. only tor exits, or only hits from one country) only read the
+hits that match, see HitFilter"""
+import os
+import re
+import json
+import shutil
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+import token_table
+
+# Part of every segment, increase it if segments change,
+# so outdated segments are built again
+HIT_STORE_VERSION = 1
+# Stored as category codes, or as booleans, conditions compare against these
+CATEGORY_COLUMNS = token_table.CATEGORICAL_COLUMNS + ["country", "region",
+        "browser_family", "os_family"]
+BOOLEAN_COLUMNS = ["is_tor_relay", "is_mobile"]
+# Columns conditions can test, token is the name of the token file
+FILTER_COLUMNS = ["token"] + CATEGORY_COLUMNS + BOOLEAN_COLUMNS
+
+# Times relative to now, e.g. 7d for the last seven days
+_relative_time_pattern = re.compile(r"^(\d+)([mhdw])$")
+_relative_time_units = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+_condition_pattern = re.compile(r"^(\w+)\s*(!?=)\s*(.*)$")
+
+
+def get_token_name(filename):
+    """Name of the token of a token file, e.g. webpage for path/webpage.csv"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def parse_time(text, now=None):
+    """Returns nanoseconds since epoch of a UTC time like 2023-01-31 or
+    2023-01-31 12:00, or of a time relative to now (UTC) like 30m, 12h, 7d or 2w.
+    Raises ValueError if text is neither"""
+    match = _relative_time_pattern.match(text.strip())
+    if match is not None:
+        if now is None:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+        moment = now - timedelta(**{_relative_time_units[match.group(2)]: int(match.group(1))})
+    else:
+        try:
+            moment = datetime.fromisoformat(text.strip())
+        except ValueError:
+            raise ValueError(f"Can't read the time {text!r}, "\
+                    "use e.g. 2023-01-31, \"2023-01-31 12:00\" or 7d") from None
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return pd.Timestamp(moment).value
+
+
+class HitFilter:
+    """Selects the hits with since <= timestamp < until, both in
+    nanoseconds since epoch or None, that match all conditions. A condition
+    is a (column, values, negate) tuple, it matches hits whose value of
+    column is one of values, or none of them with negate"""
+
+    def __init__(self, since=None, until=None, conditions=()):
+        self.since = since
+        self.until = until
+        self.conditions = list(conditions)
+
+    @classmethod
+    def from_arguments(cls, since=None, until=None, where=()):
+        """Builds the filter of --since, --until and --where arguments, see
+        parse_time. Conditions are given as column=value or column!=value,
+        with several values separated by commas, e.g. country=DE,NL.
+        Raises ValueError for arguments that can't be read"""
+        conditions = []
+        for condition in where or ():
+            match = _condition_pattern.match(condition.strip())
+            if match is None:
+                raise ValueError(f"Can't read the condition {condition!r}, "\
+                        "use e.g. country=DE or browser_family!=Chrome")
+            column, operator, values = match.groups()
+            if column not in FILTER_COLUMNS:
+                raise ValueError(f"Can't filter on {column}, "\
+                        f"use one of {', '.join(FILTER_COLUMNS)}")
+            values = [value.strip() for value in values.split(",")]
+            if column in BOOLEAN_COLUMNS:
+                if any(value.lower() not in ("true", "false") for value in values):
+                    raise ValueError(f"{column} is either true or false")
+                values = [value.lower() == "true" for value in values]
+            conditions.append((column, values, operator == "!="))
+        return cls(None if since is None else parse_time(since),
+                None if until is None else parse_time(until), conditions)
+
+    def matches_token(self, token):
+        for column, values, negate in self.conditions:
+            if column == "token" and (token in values) == negate:
+                return False
+        return True
+
+    @property
+    def row_conditions(self):
+        """Conditions that are tested per hit, all but the ones on token"""
+        return [condition for condition in self.conditions if condition[0] != "token"]
+
+
+class HitStoreSegment:
+    """The hits of a single token file, sorted by timestamp, with one .npy
+    file per column in folder: timestamps in nanoseconds, category codes,
+    and booleans. Categories and the size and mtime of the token file are
+    kept in segment.json. Columns are memory mapped, so only the rows
+    that are accessed are read"""
+    meta_filename = "segment.json"
+
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+        self._arrays = {}
+
+    @classmethod
+    def load(cls, folder):
+        """Returns the segment in folder, or None if there is none"""
+        try:
+            with open(os.path.join(folder, cls.meta_filename)) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        return cls(folder, meta)
+
+    @classmethod
+    def write(cls, folder, table, source_meta):
+        """Writes a table as returned by token_table.load_token_table as
+        segment. The folder is replaced only once the segment is complete"""
+        token_table.add_derived_columns(table)
+        timestamps = table["timestamp"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        order = np.argsort(timestamps, kind="stable")
+
+        temporary_folder = folder + ".tmp"
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        os.makedirs(temporary_folder)
+        np.save(os.path.join(temporary_folder, "timestamp.npy"), timestamps[order])
+        categories = {}
+        for column in CATEGORY_COLUMNS:
+            values = table[column]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype("category")
+            categories[column] = values.cat.categories.tolist()
+            np.save(os.path.join(temporary_folder, column + ".npy"),
+                    values.cat.codes.to_numpy()[order])
+        for column in BOOLEAN_COLUMNS:
+            np.save(os.path.join(temporary_folder, column + ".npy"),
+                    table[column].to_numpy(dtype=bool)[order])
+
+        meta = dict(source_meta, version=HIT_STORE_VERSION, hits=len(table),
+                categories=categories)
+        with open(os.path.join(temporary_folder, cls.meta_filename), "w") as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(temporary_folder, folder)
+        return cls(folder, meta)
+
+    def _get_array(self, column):
+        if column not in self._arrays:
+            self._arrays[column] = np.load(os.path.join(self.folder, column + ".npy"),
+                    mmap_mode="r")
+        return self._arrays[column]
+
+    def get_row_range(self, since=None, until=None):
+        """Returns (start, stop) of the rows with since <= timestamp < until,
+        found by binary search of the sorted timestamps"""
+        timestamps = self._get_array("timestamp")
+        start = 0 if since is None else int(np.searchsorted(timestamps, since, side="left"))
+        stop = len(timestamps) if until is None else \
+                int(np.searchsorted(timestamps, until, side="left"))
+        return start, max(start, stop)
+
+    def _match_condition(self, condition, start, stop):
+        """Returns a boolean mask of the rows from start to stop that match"""
+        column, values, negate = condition
+        if column in BOOLEAN_COLUMNS:
+            matching_values = values
+        else:
+            # Compare codes, so strings are never read
+            matching_values = [code for code, category
+                    in enumerate(self.meta["categories"][column]) if category in values]
+        mask = np.isin(self._get_array(column)[start:stop], matching_values)
+        return ~mask if negate else mask
+
+    def select(self, hit_filter, columns=None):
+        """Returns the hits that match the filter, as table in the format
+        of token_table.load_token_table with derived columns. Only reads
+        the given columns, all if None, of hits in the time window"""
+        start, stop = self.get_row_range(hit_filter.since, hit_filter.until)
+        mask = None
+        for condition in hit_filter.row_conditions:
+            condition_mask = self._match_condition(condition, start, stop)
+            mask = condition_mask if mask is None else mask & condition_mask
+        rows = slice(start, stop) if mask is None else np.flatnonzero(mask) + start
+
+        if columns is None:
+            columns = ["timestamp"] + CATEGORY_COLUMNS + BOOLEAN_COLUMNS
+        table = {}
+        for column in columns:
+            values = np.asarray(self._get_array(column)[rows])
+            if column == "timestamp":
+                values = pd.to_datetime(values)
+            elif column in CATEGORY_COLUMNS:
+                values = pd.Categorical.from_codes(values,
+                        categories=self.meta["categories"][column])
+            table[column] = values
+        return pd.DataFrame(table)
+
+
+class HitStore:
+    """Local store of the hits of all token files it was given, each as a
+    HitStoreSegment in its own subfolder of folder. A segment is built
+    again if the size or mtime of its token file changed.
+    Token conditions of a filter skip whole segments, the sorted timestamps
+    of a segment are binary searched for the time window, and other
+    conditions only compare category codes of hits within the window.
+    Counts built and reused segments, so callers can report them"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.segments_built = 0
+        self.segments_reused = 0
+
+    def _get_segment_folder(self, filename):
+        path_hash = hashlib.sha256(os.path.abspath(filename).encode("utf-8")).hexdigest()
+        return os.path.join(self.folder, path_hash[:16])
+
+    def get_segment(self, filename, binary_format=None):
+        """Returns the segment of a token file (csv or binary, see
+        token_table.load_token_table), building it if it is outdated"""
+        stat = os.stat(filename)
+        source_meta = {"source": os.path.abspath(filename), "size": stat.st_size,
+                "mtime": stat.st_mtime}
+        segment_folder = self._get_segment_folder(filename)
+        segment = HitStoreSegment.load(segment_folder)
+        if segment is not None and segment.meta.get("version") == HIT_STORE_VERSION and \
+                all(segment.meta.get(key) == value for key, value in source_meta.items()):
+            self.segments_reused += 1
+            return segment
+
+        self.segments_built += 1
+        os.makedirs(self.folder, exist_ok=True)
+        table = token_table.load_token_table(filename, binary_format=binary_format)
+        return HitStoreSegment.write(segment_folder, table, source_meta)
+
+    def select(self, filename, hit_filter, columns=None, binary_format=None):
+        """Returns the hits of a token file that match the filter, see
+        HitStoreSegment.select, or None if the filter excludes the token"""
+        if not hit_filter.matches_token(get_token_name(filename)):
+            return None
+        return self.get_segment(filename, binary_format).select(hit_filter, columns)
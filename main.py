@@ -4,26 +4,70 @@
 
 import csv
 import os
+import re
+import glob
+import html
+import heapq
+import itertools
+import tempfile
 import argparse
 import logging
 import quopri
 import ipaddress
+from email import message_from_bytes
 from datetime import datetime
 from collections import Counter
-
-import requests
-from bs4 import BeautifulSoup
-
-import analysis
+from concurrent.futures import ProcessPoolExecutor
+
+import pipeline_stats
+from manifest import ProcessedEmailManifest
+from email_sources import list_email_sources
+from watch import EmailInputWatcher, DEFAULT_POLL_SECONDS
+from enrichment import (GeoCache, GeoDatabase, IpinfoResolver, TorExitSnapshots,
+        DEFAULT_GEO_CACHE_TTL_DAYS, DEFAULT_TOR_SNAPSHOT_MAX_AGE_HOURS)
+# analysis, token_table and aggregation_cache pull in pandas and the plotting
+# stack, BeautifulSoup is only needed for emails the pattern does not match.
+# They are imported by the functions that use them, so parsing emails,
+# lookups and --help don't pay for them, see benchmarks/check_import_time.py
+
+# Hits are enriched and written in batches of this size, which bounds memory use
+PIPELINE_BATCH_SIZE = 1000
+# Emails per worker that are handed to the process pool at once
+PARSE_WINDOW_PER_WORKER = 64
+# Rows that sort_csv_by_timestamp sorts in memory at once
+SORT_CHUNK_ROWS = 100000
+# Keys of analysis.TIME_BUCKETS and token_table.BINARY_FORMATS,
+# so arguments can be parsed without importing them
+TIME_BUCKET_NAMES = ["minute", "hour", "day"]
+BINARY_FORMAT_NAMES = ["parquet", "feather"]
+# Environment variable the ipinfo.io api key is read from if no option gives it
+IPINFO_API_KEY_VARIABLE = "IPINFO_API_KEY"
+MISSING_IPINFO_API_KEY_MESSAGE = "Looking up geo info needs an ipinfo.io api key, "\
+        f"please use --ipinfo_api_key, set {IPINFO_API_KEY_VARIABLE} or use --geo_db"
+# File formats matplotlib (as pinned in requirements.txt) can save figures in
+GRAPH_FORMAT_NAMES = ["eps", "jpeg", "jpg", "pdf", "pgf", "png", "ps", "raw", "rgba",
+        "svg", "svgz", "tif", "tiff", "webp"]
 
 class TokenHitEnrichmentClass:
     """Convenience class to store data used for lookups that
     we need globally     and only want to initialize once"""
-    tor_node_list = []
+    # TorExitSnapshots, created without snapshot folder on first use if none is set
+    tor_exits = None
     url_of_tor_node_list = "https://check.torproject.org/torbulkexitlist"
 
     url_of_ipinfo = "https://ipinfo.io/{ip}?token={token}"
-    ipinfo_api_key = ADD_YOUR_API_KEY
+    # Set to None to only use single ip lookups
+    url_of_ipinfo_batch = "https://ipinfo.io/batch?token={token}"
+    # Set by set_up_lookups, see get_ipinfo_api_key
+    ipinfo_api_key = None
+    # Number of geo info requests that may be in flight at once
+    geo_concurrency = 8
+    # GeoCache, created in memory on first use if none is set
+    geo_cache = None
+    # IpinfoResolver, created on first use
+    geo_resolver = None
+    # GeoDatabase, if set it replaces all ipinfo lookups
+    geo_db = None
 
 class TokenHit:
     """Corresponds to data from a single email"""
@@ -38,16 +82,9 @@ class TokenHit:
         self.src_ip = src_ip
         self.input_channel = input_channel
 
-        # Lookups necessary
-        if geo_info is None:
-            self.get_geo_info(src_ip)
-        else:
-            self.geo_info = geo_info
-
-        if is_tor_relay is None:
-            self.check_ip_for_tor_exit(src_ip)
-        else:
-            self.is_tor_relay = is_tor_relay
+        # Lookups necessary, filled in by enrich_token_hits
+        self.geo_info = geo_info
+        self.is_tor_relay = is_tor_relay
 
         # These don't exist for this type of token
         self.referer = referer
@@ -59,25 +96,14 @@ class TokenHit:
 
     def check_ip_for_tor_exit(self, ip):
         """Looks up whether the ip of this
-        TokenHit is currently a tor exit node,
+        TokenHit is a tor exit node, according to the exit list
+        closest to the time of this hit,
         and sets the local variable correspondingly"""
-        if len(TokenHitEnrichmentClass.tor_node_list) == 0:
-            # Initialize tor node list
-            logging.info("Getting list of tor nodes from %s",
+        if TokenHitEnrichmentClass.tor_exits is None:
+            TokenHitEnrichmentClass.tor_exits = TorExitSnapshots(
                     TokenHitEnrichmentClass.url_of_tor_node_list)
-            response= requests.get(TokenHitEnrichmentClass.url_of_tor_node_list)
-            TokenHitEnrichmentClass.tor_node_list = response.text.split("\n")
-        TokenHitEnrichmentClass.tor_node_list.sort()
-
-        self.is_tor_relay = ip in TokenHitEnrichmentClass.tor_node_list
 
-    def get_geo_info(self, ip):
-        """Looks up geo info for the ip of this
-        TokenHit and sets the local variable correspondingly"""
-        logging.info(f"Getting geo info for {ip}")
-        json_response = requests.get(TokenHitEnrichmentClass.url_of_ipinfo.format(
-            ip=ip, token=TokenHitEnrichmentClass.ipinfo_api_key))
-        self.geo_info = json_response.text.replace("\n","")
+        self.is_tor_relay = TokenHitEnrichmentClass.tor_exits.is_tor_exit(ip, self.timestamp)
 
     def to_csv_array(self):
         """Returns data of this TokenHit as an array, ready to be written to
@@ -88,6 +114,56 @@ class TokenHit:
 
 
 
+def lookup_geo_infos(ips):
+    """Returns a dict that maps each of the given ips to its geo info.
+    Every ip is looked up once, concurrently, and only if it is not
+    in the geo cache"""
+    if TokenHitEnrichmentClass.geo_cache is None:
+        # Not persisted, but still dedupes lookups within this run
+        TokenHitEnrichmentClass.geo_cache = GeoCache(":memory:")
+    if TokenHitEnrichmentClass.geo_resolver is None:
+        TokenHitEnrichmentClass.geo_resolver = IpinfoResolver(
+                TokenHitEnrichmentClass.url_of_ipinfo,
+                TokenHitEnrichmentClass.ipinfo_api_key,
+                TokenHitEnrichmentClass.url_of_ipinfo_batch,
+                TokenHitEnrichmentClass.geo_concurrency)
+    geo_cache = TokenHitEnrichmentClass.geo_cache
+
+    geo_infos = {}
+    unresolved_ips = []
+    for ip in ips:
+        geo_infos[ip] = geo_cache.get(ip)
+        if geo_infos[ip] is None:
+            unresolved_ips.append(ip)
+
+    resolved = TokenHitEnrichmentClass.geo_resolver.resolve(unresolved_ips)
+    # Don't persist errors, e.g. from rate limiting
+    geo_cache.put_many((ip, geo_info) for ip, (geo_info, ok) in resolved.items() if ok)
+    for ip, (geo_info, _) in resolved.items():
+        geo_infos[ip] = geo_info
+    return geo_infos
+
+
+def enrich_token_hits(list_of_token_hits, stats=pipeline_stats.DISABLED):
+    """Enrichment stage: fills in geo info and tor exit status for all
+    given hits that don't have them yet. Geo info comes from the local
+    geo database if one is set, otherwise from lookup_geo_infos"""
+    with stats.stage("geo_lookup"):
+        ips = {str(hit.src_ip) for hit in list_of_token_hits if hit.geo_info is None}
+        if TokenHitEnrichmentClass.geo_db is not None:
+            geo_infos = {ip: TokenHitEnrichmentClass.geo_db.get_geo_info(ip) for ip in ips}
+        else:
+            geo_infos = lookup_geo_infos(ips)
+
+    with stats.stage("tor_check"):
+        for hit in list_of_token_hits:
+            if hit.geo_info is None:
+                hit.geo_info = geo_infos[str(hit.src_ip)]
+            if hit.is_tor_relay is None:
+                hit.check_ip_for_tor_exit(hit.src_ip)
+    return list_of_token_hits
+
+
 def create_list_from_csv(filename):
     """Takes a csv file and returns a list
     of all tokenhits contained within that csv file.
@@ -99,47 +175,140 @@ def create_list_from_csv(filename):
         next(reader) # Skip header line
 
         for line in reader:
-            token_hit = TokenHit(
-                    timestamp=line[0], src_ip=line[1], input_channel=line[3],
-                    useragent=line[7],
-                    geo_info=line[3], is_tor_relay=line[4],
-                    referer=line[5], location=line[6])
-            list_of_tokenhits.append(token_hit)
+            list_of_tokenhits.append(build_token_hit_from_csv_row(line))
     return list_of_tokenhits
 
 
-def build_token_hit_from_email(email):
-    """Expects an opened file as input. Should be a .eml file
-    that is formatted as emails sent by thinkst canary are formatted.
-    Returns a (token_reminder,TokenHit) with the data from that email.
-    Returns (None,None) if this email is not from canarytoken
-    """
-    # Startstring of html in email
+def build_token_hit_from_csv_row(line):
+    """Takes a row of a csv in the format we produce, as a list of strings"""
+    return TokenHit(
+            timestamp=line[0], src_ip=line[1], input_channel=line[2],
+            useragent=line[7],
+            geo_info=line[3], is_tor_relay=line[4],
+            referer=line[5], location=line[6])
+
 
+def enrich_csv(csv_filename, stats=pipeline_stats.DISABLED):
+    """Fills in geo info and tor exit status of all hits in a csv we produced
+    that don't have them, e.g. because it was created by the parse command.
+    Hits are read, enriched and written in batches, and the csv is replaced
+    only once it is complete. Returns the number of enriched hits"""
+    temporary_filename = csv_filename + ".tmp"
+    number_of_enriched_hits = 0
+    with open(csv_filename) as csv_file, open(temporary_filename, 'w') as enriched_file:
+        reader = csv.reader(csv_file)
+        writer = csv.writer(enriched_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(next(reader))
+        while True:
+            with stats.stage("build"):
+                batch = [build_token_hit_from_csv_row(line)
+                        for line in itertools.islice(reader, PIPELINE_BATCH_SIZE)]
+            if len(batch) == 0:
+                break
+            # Unlooked up fields are written as empty strings
+            missing = [hit for hit in batch if hit.geo_info == "" or hit.is_tor_relay == ""]
+            for hit in missing:
+                hit.geo_info = hit.geo_info or None
+                hit.is_tor_relay = hit.is_tor_relay or None
+            enrich_token_hits(missing, stats)
+            with stats.stage("write"):
+                writer.writerows(hit.to_csv_array() for hit in batch)
+            number_of_enriched_hits += len(missing)
+            stats.count("token_hits", len(batch))
+    os.replace(temporary_filename, csv_filename)
+    return number_of_enriched_hits
+
+
+# Labels of the <td> label/value pairs we read from canary emails
+EMAIL_FIELD_LABELS = ("Token Reminder", "Channel", "Time", "Source IP", "User Agent")
+# Email appears to be compressed- class names are not consistent between emails,
+# so we only rely on the label cell being followed by the value cell
+_email_field_pattern = re.compile(
+        r"<td[^>]*>\s*(" + "|".join(EMAIL_FIELD_LABELS) + r")\s*</td>\s*<td[^>]*>(.*?)</td>",
+        re.DOTALL)
+_html_tag_pattern = re.compile(r"<[^>]+>")
+
+
+def _extract_fields_with_pattern(decoded_html):
+    """Targeted extraction of all EMAIL_FIELD_LABELS in a single pass.
+    Returns None if not all labels were found"""
+    fields = {}
+    for match in _email_field_pattern.finditer(decoded_html):
+        value = html.unescape(_html_tag_pattern.sub("", match.group(2)))
+        fields.setdefault(match.group(1), value)
+    if len(fields) != len(EMAIL_FIELD_LABELS):
+        return None
+    return fields
 
+
+def _extract_fields_with_soup(decoded_html):
+    """Slow but lenient fallback for emails the pattern does not match.
+    Returns None if not all labels were found"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(decoded_html, features="lxml")
+    fields = {}
     try:
-        html_identifier = "w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd\">"
-        email_string = email.read()
-        html = email_string.split(html_identifier)[1]
-        soup = BeautifulSoup(quopri.decodestring(html), features="lxml")
-
-        # Classify emails based on TokenReminder
-        token_reminder = soup.find("td", string="Token Reminder").find_next_sibling("td").get_text()
-        if token_reminder is None:
-            # Not an canary email
-            return (None, None)
-    except IndexError:
-        return (None, None)
+        for label in EMAIL_FIELD_LABELS:
+            fields[label] = soup.find("td", string=label).find_next_sibling("td").get_text()
     except AttributeError:
-        return (None, None)
+        return None
+    return fields
+
+
+def _decode_html_with_doctype_split(email_string):
+    """Fallback for emails without a MIME html part: decodes everything
+    after the doctype of the html as quoted-printable"""
+    # Startstring of html in email
+    html_identifier = "w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd\">"
+    try:
+        html_string = email_string.split(html_identifier)[1]
+    except IndexError:
+        return None
+    return quopri.decodestring(html_string).decode("utf-8", errors="replace")
+
+
+def decode_html_of_email(email_content):
+    """Returns the decoded html body of an email, given as bytes or str.
+    The MIME structure is parsed, so the html part is found in multipart
+    emails and decoded with its own transfer encoding and charset.
+    Returns None if the email has no html"""
+    if isinstance(email_content, str):
+        email_content = email_content.encode("utf-8", errors="surrogateescape")
+    # The legacy policy leaves headers unparsed, which is much faster
+    message = message_from_bytes(email_content)
+    for part in message.walk():
+        if part.get_content_type() != "text/html":
+            continue
+        payload = part.get_payload(decode=True)
+        try:
+            return payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+        except LookupError:
+            logging.info("Unknown charset in email, decoding it as utf-8")
+            return payload.decode("utf-8", errors="replace")
+    return _decode_html_with_doctype_split(email_content.decode("utf-8", errors="replace"))
+
+
+def extract_fields_from_email(email_content):
+    """Decodes and parses the html of an email (bytes or str) formatted as
+    emails sent by thinkst canary are formatted, exactly once.
+    Returns a dict that maps each of EMAIL_FIELD_LABELS to its value,
+    or None if this email is not from canarytoken"""
+    decoded_html = decode_html_of_email(email_content)
+    # Cheap check first, other html emails are not worth the soup fallback
+    if decoded_html is None or "Token Reminder" not in decoded_html:
+        return None
 
-    # Email appears to be compressed- class names are not consistent between emails
-    channel = soup.find("td", string="Channel").find_next_sibling("td").get_text()
-    timestamp = soup.find("td", string="Time").find_next_sibling("td").get_text()
-    src_ip = soup.find("td", string="Source IP").find_next_sibling("td").get_text()
-    user_agent = soup.find("td", string="User Agent").find_next_sibling("td").get_text()
+    fields = _extract_fields_with_pattern(decoded_html)
+    if fields is None:
+        fields = _extract_fields_with_soup(decoded_html)
+    return fields
 
 
+def build_token_hit_from_fields(fields):
+    """Takes fields as returned by extract_fields_from_email,
+    returns a (token_reminder,TokenHit) with that data"""
+    src_ip = fields["Source IP"]
+
     # In some cases the src_ip field contains two ip addresses - from our data
     # It appears that the first IP is local, and the second one lookup-able
     # This tries to get rid of this edgecase
@@ -150,47 +319,159 @@ def build_token_hit_from_email(email):
         second_address = src_ip.split(", ")[1]
         ip_address = second_address
 
-    tokenhit_from_email = TokenHit(timestamp, ip_address, channel, user_agent)
-    return (token_reminder, tokenhit_from_email)
+    tokenhit_from_email = TokenHit(fields["Time"], ip_address,
+            fields["Channel"], fields["User Agent"])
+    return (fields["Token Reminder"], tokenhit_from_email)
 
 
-def write_token_hits_to_csv(csv_filename, list_of_token_hits):
-    """Creates a csv that contains all tokenhits
-    passed into this method."""
-    with open(csv_filename, 'w') as csv_file:
-        writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
+def build_token_hit_from_email(email):
+    """Expects an opened file as input. Should be a .eml file
+    that is formatted as emails sent by thinkst canary are formatted.
+    Returns a (token_reminder,TokenHit) with the data from that email.
+    Returns (None,None) if this email is not from canarytoken
+    """
+    fields = extract_fields_from_email(email.read())
+    if fields is None:
+        return (None, None)
+    return build_token_hit_from_fields(fields)
+
+
+class TokenHitCsvWriters:
+    """Write stage of build_data_csvs: keeps one csv writer open per
+    output csv and appends hits as they come in. A csv is created with
+    header when its first hit is written, unless append_to_existing is set
+    and it already exists. If mark_unsorted is set a marker file
+    <csv>.unsorted exists next to every csv until sort_csv_by_timestamp
+    has run over it, so an interrupted run can be finished later.
+    If partial is set, hits are written to <csv>.partial instead, which
+    finish() moves in place of the csv, so an interrupted run never
+    leaves a csv that looks complete"""
+
+    def __init__(self, append_to_existing=False, mark_unsorted=False, partial=False):
+        self.append_to_existing = append_to_existing
+        self.mark_unsorted = mark_unsorted
+        self.partial = partial
+        self._csv_files = {}
+        self._writers = {}
+
+    def __contains__(self, csv_filename):
+        return csv_filename in self._writers
+
+    @property
+    def csv_filenames(self):
+        """All csvs written to, in the order they were opened"""
+        return list(self._writers)
+
+    def open(self, csv_filename):
+        """Opens the writer of a csv, if it is not open yet.
+        Returns whether the csv was created, with header"""
+        if csv_filename in self._writers:
+            return False
+        append = self.append_to_existing and not self.partial and os.path.exists(csv_filename)
+        if self.mark_unsorted:
+            open(get_unsorted_marker_path(csv_filename), 'w').close()
+        self._csv_files[csv_filename] = open(self.get_path(csv_filename), 'a' if append else 'w')
+        self._writers[csv_filename] = csv.writer(self._csv_files[csv_filename],
+                quoting=csv.QUOTE_ALL)
+        if not append:
+            self._writers[csv_filename].writerow(TokenHit.csv_header)
+        return not append
+
+    def get_path(self, csv_filename):
+        """Path the hits of a csv are written to"""
+        if self.partial:
+            return get_partial_path(csv_filename)
+        return csv_filename
+
+    def write(self, csv_filename, token_hit):
+        self.open(csv_filename)
+        self._writers[csv_filename].writerow(token_hit.to_csv_array())
+
+    def flush(self):
+        for csv_file in self._csv_files.values():
+            csv_file.flush()
+
+    def close(self):
+        for csv_file in self._csv_files.values():
+            csv_file.close()
+
+    def finish(self):
+        """Moves partial csvs in place, to be called once all hits are
+        written and the csvs are closed"""
+        if not self.partial:
+            return
+        for csv_filename in self._writers:
+            os.replace(get_partial_path(csv_filename), csv_filename)
+
+
+def get_partial_path(csv_filename):
+    return csv_filename + ".partial"
+
+
+def get_unsorted_marker_path(csv_filename):
+    return csv_filename + ".unsorted"
+
+
+def sort_csv_by_timestamp(csv_filename, chunk_rows=None):
+    """Sorts the rows of a csv by timestamp with an external merge sort:
+    chunks of chunk_rows rows are sorted in memory and written to temporary
+    files, which are then merged. Rows with equal timestamps keep their order.
+    Removes the unsorted marker of the csv once done"""
+    if chunk_rows is None:
+        chunk_rows = SORT_CHUNK_ROWS
+    # Timestamps are formatted so that their string order is chronological
+    timestamp_of_row = lambda row: row[0]
+
+    chunk_files = []
+    with open(csv_filename, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        while True:
+            chunk = list(itertools.islice(reader, chunk_rows))
+            if len(chunk) == 0:
+                break
+            chunk.sort(key=timestamp_of_row)
+            chunk_file = tempfile.TemporaryFile('w+', newline='')
+            csv.writer(chunk_file, quoting=csv.QUOTE_ALL).writerows(chunk)
+            chunk_file.seek(0)
+            chunk_files.append(chunk_file)
+
+    temporary_filename = csv_filename + ".tmp"
+    with open(temporary_filename, 'w') as sorted_file:
+        writer = csv.writer(sorted_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        writer.writerows(heapq.merge(*(csv.reader(chunk_file) for chunk_file in chunk_files),
+                key=timestamp_of_row))
+
+    for chunk_file in chunk_files:
+        chunk_file.close()
+    os.replace(temporary_filename, csv_filename)
+    if os.path.exists(get_unsorted_marker_path(csv_filename)):
+        os.remove(get_unsorted_marker_path(csv_filename))
+    return csv_filename
 
-        writer.writerow(TokenHit.csv_header)
 
-        for hit in list_of_token_hits:
-            writer.writerow(hit.to_csv_array())
-    return csv_filename
+def sort_marked_csvs(base_path_to_output_csv, manifest=None, skipped_csv_filenames=()):
+    """Sorts all csvs with this prefix that have an unsorted marker, e.g.
+    because the run that appended to them was interrupted, except for the
+    skipped ones. Their new sizes are recorded in the manifest, if given"""
+    unsorted_marker_pattern = glob.escape(base_path_to_output_csv) + "*.csv.unsorted"
+    for marker_path in sorted(glob.glob(unsorted_marker_pattern)):
+        csv_filename = marker_path[:-len(".unsorted")]
+        if csv_filename not in skipped_csv_filenames and os.path.exists(csv_filename):
+            sort_csv_by_timestamp(csv_filename)
+            if manifest is not None:
+                manifest.record_csv(csv_filename)
 
 
-def get_name_if_should_not_query(email, base_path_to_output_csv, force):
-    """For a given email, checks if a csv belonging to this tag already exists.
+def get_name_if_should_not_query(token_reminder, base_path_to_output_csv, force):
+    """For a given token reminder, checks if a csv belonging to this tag already exists.
     Takes into account the current prefix (e.g. we only care for csv files with
     this prefix), and whetehr the user wants to force ignore existing csvs
     """
     if force is True:
         return None
 
-    try:
-        # Get token from email
-        html_identifier = "w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd\">"
-        email_string = email.read()
-        html = email_string.split(html_identifier)[1]
-        soup = BeautifulSoup(quopri.decodestring(html), features="lxml")
-        # Classify emails based on TokenReminder
-        token_reminder = soup.find("td", string="Token Reminder").find_next_sibling("td").get_text()
-        if token_reminder is None:
-            # Not an canary email
-            return None
-    except IndexError:
-        return None
-    except AttributeError:
-        return None
-
     # Lookup if csv exists
     full_csv_filename = base_path_to_output_csv + token_reminder+ ".csv"
     if os.path.exists(full_csv_filename):
@@ -198,55 +479,195 @@ def get_name_if_should_not_query(email, base_path_to_output_csv, force):
     return None
 
 
-def add_token_if_is_valid(email, all_token_hits, base_path_to_output_csv):
-    """Reads details from the token contained within
-    the given email to the given all_token_hits list,
-    if it belongs there"""
-    token_reminder, token = build_token_hit_from_email(email)
-
-    if token_reminder is None:
-        return
+def extract_fields_from_email_source(email_source):
+    """Reads and parses a single email source, see extract_fields_from_email.
+    This is what worker processes run, so it must not trigger any lookups"""
+    return extract_fields_from_email(email_source.read_bytes())
+
+
+def parse_email_files(email_sources, workers=1):
+    """Parse stage: yields an (email_source, fields) tuple for every given
+    email source (see email_sources), in the given order. fields is None
+    for emails that are not from canarytoken. With more than one worker
+    the emails are parsed in a process pool, a window of
+    PARSE_WINDOW_PER_WORKER emails per worker at a time. Only the sources
+    are sent to the workers, which read the emails themselves"""
+    if workers > 1:
+        window = workers * PARSE_WINDOW_PER_WORKER
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(email_sources), window):
+                window_sources = email_sources[start:start + window]
+                yield from zip(window_sources, executor.map(extract_fields_from_email_source,
+                    window_sources, chunksize=max(1, PARSE_WINDOW_PER_WORKER // 4)))
+    else:
+        yield from zip(email_sources, map(extract_fields_from_email_source, email_sources))
 
-    token_path = base_path_to_output_csv + token_reminder+ ".csv"
-    if token_path not in all_token_hits:
-        all_token_hits[token_path] = []
 
-    all_token_hits[token_path].append(token)
+def get_manifest_path(base_path_to_output_csv):
+    """The manifest of processed emails lives next to the csvs we create"""
+    return base_path_to_output_csv + "processed_emails.jsonl"
 
 
-def build_data_csvs(path_to_email_folder, base_path_to_output_csv, force=False):
-    """Reads all files in the email folder, and writes
-    all tokenhits into different csv files, depending on their
-    "Token Reminder" string. base_path_to_output_csv is
-    prepended to all csvs we create. Ignores entries
-    if a csv with that reminder string (and prefix)
-    already exists, this can be toggled with force"""
-    # Iterate over all email files and create token hits
-    all_token_hits = {}
-    uncreated_csv_filenames = Counter()
+def get_existing_csv_filenames(manifest):
+    """All csvs of the manifest that were not removed since"""
+    return [csv_filename for csv_filename in manifest.csv_filenames
+            if os.path.exists(csv_filename)]
 
-    print("This might take a while")
-    for email_file in os.scandir(path_to_email_folder):
-        with open(email_file.path) as email:
-            already_existing_file = get_name_if_should_not_query(email,
-                    base_path_to_output_csv, force)
 
-            if already_existing_file is not None:
+def build_token_hits(parsed_emails, base_path_to_output_csv, skip_existing,
+        uncreated_csv_filenames, manifest=None, stats=pipeline_stats.DISABLED):
+    """Yields a (path_to_output_csv, TokenHit, email_source) tuple for
+    every parsed canary email. If skip_existing is set, emails of reminders
+    whose csv already existed before are skipped and counted in
+    uncreated_csv_filenames, unless the manifest records the csv, as hits
+    are then appended to it. Non canary emails are marked processed right away"""
+    started_csv_filenames = set()
+    for email_source, fields in parsed_emails:
+        stats.count("emails_parsed")
+        stats.report_progress()
+        if fields is None:
+            # Not an canary email
+            stats.count("non_canary_emails")
+            if manifest is not None:
+                manifest.mark_processed(email_source)
+            continue
+
+        path_to_output_csv = base_path_to_output_csv + fields["Token Reminder"] + ".csv"
+        if path_to_output_csv not in started_csv_filenames:
+            already_existing_file = get_name_if_should_not_query(fields["Token Reminder"],
+                    base_path_to_output_csv, not skip_existing)
+            if already_existing_file is not None and \
+                    (manifest is None or already_existing_file not in manifest.csv_states):
                 logging.info(f"Identified file {already_existing_file} as existing, blocking edit")
                 # Don't overwrite/query these.
                 # Decide this early to limit potentially expensive API lookups
                 # Also prepare to print out list of these files
                 uncreated_csv_filenames[already_existing_file] += 1
+                stats.count("emails_of_existing_csvs")
                 continue
-            # Reset stream to beginning, since we already
-            # read it above
-            email.seek(0, 0)
-            add_token_if_is_valid(email, all_token_hits, base_path_to_output_csv)
-
-    created_csv_filenames = []
-    for path_to_output_csv, hits_at_path in all_token_hits.items():
-        created_csv_filenames.append(
-                write_token_hits_to_csv(path_to_output_csv, hits_at_path))
+            started_csv_filenames.add(path_to_output_csv)
+
+        _, token_hit = build_token_hit_from_fields(fields)
+        yield (path_to_output_csv, token_hit, email_source)
+
+
+def batch_token_hits(token_hits, batch_size=None):
+    """Yields lists of at most batch_size tuples as yielded by build_token_hits"""
+    if batch_size is None:
+        batch_size = PIPELINE_BATCH_SIZE
+    while True:
+        batch = list(itertools.islice(token_hits, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def enrich_in_batches(token_hits, batch_size=None, stats=pipeline_stats.DISABLED):
+    """Enrich stage: yields lists of at most batch_size tuples as yielded by
+    build_token_hits, after enriching their hits together"""
+    for batch in batch_token_hits(token_hits, batch_size):
+        # TokenHits are only built and enriched here, in the main process
+        enrich_token_hits([token_hit for _, token_hit, _ in batch], stats)
+        yield batch
+
+
+def build_data_csvs(email_sources, base_path_to_output_csv, force=False, workers=1,
+        incremental=False, sort=True, stats=pipeline_stats.DISABLED, enrich=True,
+        manifest=None, mark_unsorted=None):
+    """Reads all given email sources (see email_sources), and writes
+    all tokenhits into different csv files, depending on their
+    "Token Reminder" string. base_path_to_output_csv is
+    prepended to all csvs we create. Ignores entries
+    if a csv with that reminder string (and prefix)
+    already exists, this can be toggled with force.
+    Runs as a pipeline of generators (scan, parse, enrich, write), so only
+    a batch of hits is kept in memory, and rows are appended to the csvs as
+    they are enriched. Parsing is spread over the given number of worker
+    processes. Afterwards all written csvs are sorted by timestamp, unless
+    sort is False, so the output does not depend on the number of workers.
+    Outside of incremental mode csvs are only moved in place once they are
+    complete, see TokenHitCsvWriters. In incremental mode they are marked as
+    unsorted until they are sorted, by default only if they are sorted here.
+    In incremental mode emails recorded in the manifest of processed emails
+    are skipped, hits from new emails are appended to the csvs the manifest
+    records, and the manifest is updated after every batch, so an
+    interrupted run continues where it stopped. Rows an interrupted run
+    appended after the last update are cut off first, as their emails are
+    read again. Csvs that exist but are not recorded, e.g. from a run that
+    was not incremental, are left as they are unless force is set, like in
+    a run that is not incremental. A manifest that is already loaded can be
+    passed, otherwise it is loaded from next to the csvs.
+    Without enrich no lookups are done, geo info and tor exit status are
+    left empty for enrich_csv to fill in later.
+    Time spent in every stage and counts are recorded in stats"""
+    uncreated_csv_filenames = Counter()
+    if mark_unsorted is None:
+        mark_unsorted = sort and incremental
+
+    stats.count("emails_scanned", len(email_sources))
+    if not incremental:
+        manifest = None
+    else:
+        with stats.stage("scan"):
+            if manifest is None:
+                manifest = ProcessedEmailManifest(get_manifest_path(base_path_to_output_csv))
+            if not force:
+                number_of_emails = len(email_sources)
+                email_sources = [email_source for email_source in email_sources
+                        if not manifest.is_processed(email_source)]
+                stats.count("emails_already_processed", number_of_emails - len(email_sources))
+                for csv_filename in manifest.truncate_csvs():
+                    logging.info(f"Removed hits of unfinished emails from {csv_filename}")
+        logging.info(f"Incremental mode, {len(email_sources)} new emails")
+
+    writers = TokenHitCsvWriters(append_to_existing=incremental and not force,
+            mark_unsorted=mark_unsorted, partial=not incremental)
+    try:
+        parsed_emails = stats.iterate("parse", parse_email_files(email_sources, workers))
+        token_hits = stats.iterate("build", build_token_hits(parsed_emails,
+                base_path_to_output_csv, not force,
+                uncreated_csv_filenames, manifest, stats))
+        if enrich:
+            batches = enrich_in_batches(token_hits, stats=stats)
+        else:
+            batches = batch_token_hits(token_hits)
+        for batch in batches:
+            with stats.stage("write"):
+                for path_to_output_csv, token_hit, _ in batch:
+                    if writers.open(path_to_output_csv) and manifest is not None:
+                        # Recorded with only the header, before any of its
+                        # rows can reach the disk, so truncate_csvs can cut
+                        # off the rows of an interrupted run
+                        writers.flush()
+                        manifest.record_csv(path_to_output_csv)
+                        manifest.save()
+                    writers.write(path_to_output_csv, token_hit)
+                writers.flush()
+                stats.count("token_hits", len(batch))
+                if manifest is not None:
+                    # Only once their hits are written
+                    for path_to_output_csv in {path for path, _, _ in batch}:
+                        manifest.record_csv(path_to_output_csv)
+                    for path_to_output_csv, _, email_source in batch:
+                        manifest.mark_processed(email_source, path_to_output_csv)
+                    manifest.save()
+        if manifest is not None:
+            manifest.save()
+    finally:
+        writers.close()
+
+    created_csv_filenames = writers.csv_filenames
+    if sort:
+        with stats.stage("sort"):
+            # Also finish csvs of interrupted earlier runs
+            sort_marked_csvs(base_path_to_output_csv, manifest, created_csv_filenames)
+            for csv_filename in created_csv_filenames:
+                sort_csv_by_timestamp(writers.get_path(csv_filename))
+                if manifest is not None:
+                    manifest.record_csv(csv_filename)
+            if manifest is not None:
+                manifest.save()
+    writers.finish()
     return created_csv_filenames, uncreated_csv_filenames
 
 
@@ -275,18 +696,264 @@ def print_created_file_details(created_filenames, no_visualize):
     if no_visualize:
         print("Skipping visualization")
 
-def create_csvs(input_folder, output_prefix, force, no_visualize):
-    created_filenames, uncreated_filenames = build_data_csvs(input_folder,
-            output_prefix, force)
+def print_geo_cache_details(geo_cache):
+    """Prints how many geo info lookups the cache saved"""
+    if geo_cache is None:
+        return
+    print(f"Geo info cache {geo_cache.path}: {geo_cache.hits} hits, {geo_cache.misses} misses")
+
+def count_lookups(stats):
+    """Adds the requests and cache hits of all lookups to stats"""
+    geo_cache = TokenHitEnrichmentClass.geo_cache
+    if geo_cache is not None:
+        stats.count("geo_cache_hits", geo_cache.hits)
+        stats.count("geo_cache_misses", geo_cache.misses)
+    if TokenHitEnrichmentClass.geo_resolver is not None:
+        stats.count("geo_requests", TokenHitEnrichmentClass.geo_resolver.requests_sent)
+    if TokenHitEnrichmentClass.tor_exits is not None:
+        stats.count("tor_list_downloads", TokenHitEnrichmentClass.tor_exits.downloads)
+
+def get_default_geo_cache_path(output_prefix):
+    """The geo cache lives next to the csvs we create"""
+    return os.path.join(os.path.dirname(output_prefix), "geo_cache.sqlite")
+
+def get_default_aggregation_cache_path(output_prefix):
+    """The aggregation cache lives next to the csvs we create"""
+    return os.path.join(os.path.dirname(output_prefix), "aggregation_cache.sqlite")
+
+def get_default_hit_store_path(output_prefix):
+    """The hit store lives next to the csvs we create"""
+    return os.path.join(os.path.dirname(output_prefix), "hit_store")
+
+def get_default_tor_snapshot_folder(output_prefix):
+    """Tor exit list snapshots are stored next to the csvs we create"""
+    return os.path.join(os.path.dirname(output_prefix), "tor_exit_lists")
+
+def get_ipinfo_api_key(ipinfo_api_key=None):
+    """Returns the given ipinfo.io api key, or the one in the
+    IPINFO_API_KEY_VARIABLE environment variable, None if neither is set"""
+    if ipinfo_api_key is not None:
+        return ipinfo_api_key
+    return os.environ.get(IPINFO_API_KEY_VARIABLE) or None
+
+def set_up_lookups(output_prefix, geo_cache_path=None,
+        geo_cache_ttl_days=DEFAULT_GEO_CACHE_TTL_DAYS,
+        geo_concurrency=TokenHitEnrichmentClass.geo_concurrency,
+        tor_snapshot_folder=None, tor_max_age_hours=DEFAULT_TOR_SNAPSHOT_MAX_AGE_HOURS,
+        tor_history=False, geo_db_path=None, ipinfo_api_key=None):
+    """Prepares TokenHitEnrichmentClass for enriching hits. The geo cache and
+    tor exit lists are stored next to the csvs with output_prefix by default.
+    Without a geo database geo info comes from ipinfo.io, which needs an api
+    key, see get_ipinfo_api_key. Raises ValueError if there is none"""
+    if geo_db_path is not None:
+        TokenHitEnrichmentClass.geo_db = GeoDatabase(geo_db_path)
+    else:
+        TokenHitEnrichmentClass.ipinfo_api_key = get_ipinfo_api_key(ipinfo_api_key)
+        if TokenHitEnrichmentClass.ipinfo_api_key is None:
+            raise ValueError(MISSING_IPINFO_API_KEY_MESSAGE)
+    if tor_snapshot_folder is None:
+        tor_snapshot_folder = get_default_tor_snapshot_folder(output_prefix)
+    TokenHitEnrichmentClass.tor_exits = TorExitSnapshots(
+            TokenHitEnrichmentClass.url_of_tor_node_list, tor_snapshot_folder,
+            tor_max_age_hours * 60 * 60, tor_history)
+    TokenHitEnrichmentClass.geo_concurrency = geo_concurrency
+    TokenHitEnrichmentClass.geo_resolver = None
+    if geo_cache_path is None:
+        geo_cache_path = get_default_geo_cache_path(output_prefix)
+    TokenHitEnrichmentClass.geo_cache = GeoCache(geo_cache_path,
+            geo_cache_ttl_days * 24 * 60 * 60)
+
+def finish_lookups(stats=pipeline_stats.DISABLED):
+    """Reports the lookups done since set_up_lookups and closes the geo cache"""
+    count_lookups(stats)
+    print_geo_cache_details(TokenHitEnrichmentClass.geo_cache)
+    TokenHitEnrichmentClass.geo_cache.close()
+    TokenHitEnrichmentClass.geo_cache = None
+
+def create_csvs(email_sources, output_prefix, force, no_visualize, workers=1,
+        geo_cache_path=None, geo_cache_ttl_days=DEFAULT_GEO_CACHE_TTL_DAYS,
+        geo_concurrency=TokenHitEnrichmentClass.geo_concurrency,
+        tor_snapshot_folder=None, tor_max_age_hours=DEFAULT_TOR_SNAPSHOT_MAX_AGE_HOURS,
+        tor_history=False, geo_db_path=None, incremental=False, sort=True,
+        stats=pipeline_stats.DISABLED, enrich=True, ipinfo_api_key=None):
+    if enrich:
+        set_up_lookups(output_prefix, geo_cache_path, geo_cache_ttl_days,
+                geo_concurrency, tor_snapshot_folder, tor_max_age_hours,
+                tor_history, geo_db_path, ipinfo_api_key)
+
+    print("This might take a while")
+    created_filenames, uncreated_filenames = build_data_csvs(email_sources,
+            output_prefix, force, workers, incremental, sort, stats, enrich)
     print_uncreated_file_details(uncreated_filenames)
     print_created_file_details(created_filenames, no_visualize)
+    if enrich:
+        finish_lookups(stats)
     return created_filenames, uncreated_filenames
 
 
+def write_binary_copies(csv_filenames, binary_format, stats=pipeline_stats.DISABLED):
+    """Creates the binary copy of every csv, see token_table.load_token_table"""
+    import token_table
+    with stats.stage("write"):
+        for csv_filename in csv_filenames:
+            token_table.load_token_table(csv_filename, binary_format=binary_format)
 
 
-
-def main():
+def add_email_arguments(parser):
+    parser.add_argument('-if', '--input_folder', help='Path to a folder of .eml files')
+    parser.add_argument('-im', '--input_mbox', help='Path to an mbox file of emails')
+    parser.add_argument('-imd', '--input_maildir', help='Path to a Maildir of emails')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='Overwrite existing .csvs, even if they already exist')
+    parser.add_argument('-inc', '--incremental', action='store_true',
+            help='Only parse emails that were not processed before, '\
+            'and add their hits to existing .csvs')
+    parser.add_argument('--no_sort', action='store_true',
+            help='Keep hits in the order of the email files instead of '\
+            'sorting the created .csvs by timestamp')
+
+def add_lookup_arguments(parser):
+    parser.add_argument('-gc', '--geo_cache',
+            help='Path of the sqlite file that caches geo info lookups. '\
+            'Defaults to geo_cache.sqlite next to the created csvs')
+    parser.add_argument('-gt', '--geo_cache_ttl', type=float, default=DEFAULT_GEO_CACHE_TTL_DAYS,
+            help='Number of days after which cached geo info is looked up again')
+    parser.add_argument('-gn', '--geo_concurrency', type=int,
+            default=TokenHitEnrichmentClass.geo_concurrency,
+            help='Maximum number of concurrent geo info requests')
+    parser.add_argument('-ts', '--tor_snapshots',
+            help='Folder that downloaded tor exit lists are stored in. '\
+            'Defaults to tor_exit_lists next to the created csvs')
+    parser.add_argument('-tm', '--tor_max_age', type=float, default=DEFAULT_TOR_SNAPSHOT_MAX_AGE_HOURS,
+            help='Number of hours a stored tor exit list is used before a new one is downloaded')
+    parser.add_argument('-th', '--tor_history', action='store_true',
+            help='Check each hit against the stored tor exit list closest to its timestamp')
+    parser.add_argument('-gd', '--geo_db',
+            help='Local ip range database (.mmdb, or .csv with start_ip, end_ip, '\
+            'country, region columns) that is used instead of ipinfo.io')
+    parser.add_argument('-ik', '--ipinfo_api_key',
+            help='API key for ipinfo.io, not needed with --geo_db. '\
+            f'Defaults to the {IPINFO_API_KEY_VARIABLE} environment variable')
+
+def add_binary_format_argument(parser):
+    parser.add_argument('-bf', '--binary_format', choices=BINARY_FORMAT_NAMES,
+            help='Keep a binary copy of every csv in this format, '\
+            'later visualizations read it instead of the csv. Requires pyarrow')
+
+def add_visualize_arguments(parser):
+    parser.add_argument('-od', '--output_dir',
+            help='Render graphs to files in this folder instead of showing them')
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=GRAPH_FORMAT_NAMES,
+            metavar='FORMAT', help='File formats of rendered graphs, e.g. png svg')
+    parser.add_argument('--dpi', type=int, default=100,
+            help='Resolution of rendered graphs')
+    parser.add_argument('--grid', default='2x3',
+            help='Rows and columns of graphs in a figure, e.g. 2x3')
+    parser.add_argument('--separate_graphs', action='store_true',
+            help='Render every graph to its own file')
+    parser.add_argument('--time_bucket', default='auto',
+            choices=['auto'] + TIME_BUCKET_NAMES,
+            help='Size of the time buckets hits over time are counted in')
+    parser.add_argument('--max_points', type=int,
+            help='Maximum number of points per token in graphs over time')
+    parser.add_argument('-ac', '--aggregation_cache',
+            help='Path of the sqlite file that caches the counts graphs are drawn from. '\
+            'Defaults to aggregation_cache.sqlite next to the created csvs')
+    parser.add_argument('--no_aggregation_cache', action='store_true',
+            help='Count the hits of every csv again instead of using cached counts')
+    parser.add_argument('--since',
+            help='Only draw hits at or after this UTC time, e.g. 2023-01-31, '\
+            '"2023-01-31 12:00", or a time relative to now, e.g. 7d, 12h or 30m')
+    parser.add_argument('--until',
+            help='Only draw hits before this UTC time, given like --since')
+    parser.add_argument('--where', action='append',
+            help='Only draw hits that match this condition, e.g. country=DE, '\
+            'is_tor_relay=true, browser_family!=Chrome or token=webpage,docs. '\
+            'Can be given several times, hits have to match all conditions')
+    parser.add_argument('-hs', '--hit_store',
+            help='Folder of the indexed hit store that --since, --until and --where '\
+            'read hits from. Defaults to hit_store next to the created csvs')
+
+def add_profile_arguments(parser):
+    parser.add_argument('-pf', '--profile', action='store_true',
+            help='Show a live progress rate, and the time spent in every stage at the end')
+    parser.add_argument('-sj', '--stats_json',
+            help='Write the time spent in every stage and counts of processed '\
+            'emails, hits and requests to this json file')
+    parser.add_argument('-ps', '--profile_stage', choices=pipeline_stats.STAGES,
+            help='Run this stage under cProfile. Parsing with several workers '\
+            'only profiles waiting for them')
+    parser.add_argument('-po', '--profile_output',
+            help='File the cProfile stats of --profile_stage are written to. '\
+            'Defaults to <stage>.prof')
+
+def build_argument_parser():
+    """Without a command all steps run as requested by the arguments,
+    the parse, enrich and visualize commands run a single step.
+    Returns the parser and a dict of the parsers of the commands"""
+    parser = argparse.ArgumentParser(epilog='Commands run a single step and only '\
+            'load what it needs, e.g. "python main.py parse --help"')
+    commands = parser.add_subparsers(dest='command', metavar='{parse,enrich,visualize}',
+            help='Step to run, leave out to run all steps the arguments ask for')
+
+    add_email_arguments(parser)
+    parser.add_argument('-ic', '--input_csvs', action='append', type=str,
+            help='List of .csv that should be drawn. '\
+            'If --input_folder is set this defaults to all files that would be created')
+    parser.add_argument('-p', '--prefix', default="",
+            help='Prefix for the csvs that are created by the email parsing step')
+    parser.add_argument('-nv', '--no_visualize', action='store_true',
+            help='Skip the visualization step. Overrides --input_csvs')
+    add_binary_format_argument(parser)
+    add_visualize_arguments(parser)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+            help='Number of processes used to parse emails and render graphs')
+    parser.add_argument('-wa', '--watch', action='store_true',
+            help='Keep running and handle emails as they arrive: their hits are '\
+            'appended to the csvs and the graphs of their tokens are rendered again. '\
+            'Implies --incremental, stop with Ctrl+C')
+    parser.add_argument('--poll_interval', type=float, default=DEFAULT_POLL_SECONDS,
+            help='Seconds between two checks for new emails in --watch mode, '\
+            'unless the watchdog package is installed')
+    add_lookup_arguments(parser)
+    add_profile_arguments(parser)
+
+    parse_parser = commands.add_parser('parse',
+            help='Create csvs out of emails, without looking up geo info and tor exits')
+    add_email_arguments(parse_parser)
+    parse_parser.add_argument('-p', '--prefix', default="",
+            help='Prefix for the csvs that are created')
+    parse_parser.add_argument('-w', '--workers', type=int, default=1,
+            help='Number of processes used to parse emails')
+    add_profile_arguments(parse_parser)
+
+    enrich_parser = commands.add_parser('enrich',
+            help='Fill in geo info and tor exits of csvs created by parse')
+    enrich_parser.add_argument('-ic', '--input_csvs', action='append', type=str,
+            required=True, help='List of .csv that should be enriched')
+    enrich_parser.add_argument('-p', '--prefix', default="",
+            help='Prefix the csvs were created with, the geo cache and '\
+            'tor exit lists are stored next to them')
+    add_binary_format_argument(enrich_parser)
+    add_lookup_arguments(enrich_parser)
+    add_profile_arguments(enrich_parser)
+
+    visualize_parser = commands.add_parser('visualize', help='Draw graphs of csvs')
+    visualize_parser.add_argument('-ic', '--input_csvs', action='append', type=str,
+            required=True, help='List of .csv that should be drawn')
+    visualize_parser.add_argument('-p', '--prefix', default="",
+            help='Prefix the csvs were created with, the aggregation cache '\
+            'is stored next to them')
+    add_binary_format_argument(visualize_parser)
+    add_visualize_arguments(visualize_parser)
+    visualize_parser.add_argument('-w', '--workers', type=int, default=1,
+            help='Number of processes used to render graphs')
+    add_profile_arguments(visualize_parser)
+    return parser, {'parse': parse_parser, 'enrich': enrich_parser,
+            'visualize': visualize_parser}
+
+
+def main(argv=None):
     """Reads all files in the given folder,
     creates a .csv out of them, then runs
     analysis + visualizations
@@ -306,29 +973,119 @@ def main():
     python main.py --input_folder /folder --input_files webpage.csv
     Create csvs for all reminders in a folder that don't exist yet,
     afterwards only display graphs for webpage.csv
-    """
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-if', '--input_folder', help='Path to a folder of .eml files')
-    parser.add_argument('-ic', '--input_csvs', action='append', type=str,
-            help='List of .csv that should be drawn. '\
-            'If --input_folder is set this defaults to all files that would be created')
-
-    parser.add_argument('-p', '--prefix', default="",
-            help='Prefix for the csvs that are created by the email parsing step')
-
-    parser.add_argument('-nv', '--no_visualize', action='store_true',
-            help='Skip the visualization step. Overrides --input_csvs')
-    parser.add_argument('-f', '--force', action='store_true',
-            help='Overwrite existing .csvs, even if they already exist')
 
-    args = parser.parse_args()
-    if not (args.input_folder or args.input_csvs):
-        parser.error("No action requested, please use --input_folder or --input_csvs")
+    python main.py --input_mbox alerts.mbox --no-visualize
+    Create csvs for all reminders in an mbox file that don't exist yet
 
+    python main.py parse --input_folder /folder
+    python main.py enrich --input_csvs webpage.csv
+    python main.py visualize --input_csvs webpage.csv --output_dir graphs
+    The same steps one at a time, each only loads the modules it needs
+    """
+    parser, command_parsers = build_argument_parser()
+    args = parser.parse_args(argv)
+    # Errors are shown with the usage of the command they belong to
+    command_parser = command_parsers.get(args.command, parser)
+    read_emails = args.command in (None, 'parse') and \
+            (args.input_folder or args.input_mbox or args.input_maildir)
+    if args.command == 'parse' and not read_emails:
+        command_parser.error("Nothing to parse, please use --input_folder, "\
+                "--input_mbox or --input_maildir")
+    if args.command is None and not (read_emails or args.input_csvs):
+        command_parser.error("No action requested, please use --input_folder, "\
+                "--input_mbox, --input_maildir or --input_csvs")
+    if args.command is None and args.watch:
+        if not read_emails:
+            command_parser.error("--watch needs --input_folder, --input_mbox or --input_maildir")
+        if args.force:
+            command_parser.error("--watch can't be combined with --force")
+        if not args.no_visualize and args.output_dir is None:
+            command_parser.error("--watch renders graphs to files, please use --output_dir "\
+                    "or --no_visualize")
+    uses_ipinfo = args.command == 'enrich' or (args.command is None and read_emails)
+    if uses_ipinfo and args.geo_db is None and get_ipinfo_api_key(args.ipinfo_api_key) is None:
+        command_parser.error(MISSING_IPINFO_API_KEY_MESSAGE)
+    grid = None
+    hit_filter = None
+    if args.command in (None, 'visualize'):
+        try:
+            grid = tuple(int(cells) for cells in args.grid.lower().split("x"))
+        except ValueError:
+            grid = ()
+        if len(grid) != 2 or min(grid) < 1:
+            command_parser.error("--grid must be given as ROWSxCOLUMNS, e.g. 2x3")
+        if args.max_points is not None and args.max_points < 1:
+            command_parser.error("--max_points must be at least 1")
+        if args.since or args.until or args.where:
+            from hit_store import HitFilter
+            try:
+                hit_filter = HitFilter.from_arguments(args.since, args.until, args.where)
+            except ValueError as error:
+                command_parser.error(str(error))
+
+    if args.profile or args.stats_json or args.profile_stage:
+        stats = pipeline_stats.PipelineStats(args.profile_stage, args.profile)
+    else:
+        stats = pipeline_stats.DISABLED
+    try:
+        if args.command == 'parse':
+            run_parse(args, stats)
+        elif args.command == 'enrich':
+            run_enrich(args, stats)
+        elif args.command == 'visualize':
+            visualize_csvs(args.input_csvs, args, grid, stats, hit_filter)
+        elif args.watch:
+            watch_emails(args, grid, stats, hit_filter)
+        else:
+            run_pipeline(args, read_emails, grid, stats, hit_filter)
+    finally:
+        # Also for interrupted runs, these are the ones taking long
+        if stats is not pipeline_stats.DISABLED:
+            report_pipeline_stats(stats, args)
+
+
+def run_parse(args, stats):
+    """Runs the parse command: creates csvs out of emails without lookups"""
+    with stats.stage("scan"):
+        email_sources = list_email_sources(args.input_folder, args.input_mbox,
+                args.input_maildir)
+    create_csvs(email_sources, args.prefix, args.force, False, args.workers,
+            incremental=args.incremental, sort=not args.no_sort, stats=stats,
+            enrich=False)
+
+
+def run_enrich(args, stats):
+    """Runs the enrich command: fills in the lookups of the given csvs"""
+    set_up_lookups(args.prefix, args.geo_cache, args.geo_cache_ttl,
+            args.geo_concurrency, args.tor_snapshots, args.tor_max_age,
+            args.tor_history, args.geo_db, args.ipinfo_api_key)
+    for csv_filename in args.input_csvs:
+        number_of_enriched_hits = enrich_csv(csv_filename, stats)
+        print(f"Enriched {number_of_enriched_hits} token hits in {csv_filename}")
+    finish_lookups(stats)
+    if args.binary_format is not None:
+        write_binary_copies(args.input_csvs, args.binary_format, stats)
+
+
+def run_pipeline(args, read_emails, grid, stats, hit_filter=None):
+    """Runs the csv creation and visualization steps main was asked for"""
     created_filenames = []
     # Do the csv creation step
-    if args.input_folder is not None:
-        created_filenames, uncreated_filenames = create_csvs(args.input_folder, args.prefix, args.force, args.no_visualize)
+    if read_emails:
+        with stats.stage("scan"):
+            email_sources = list_email_sources(args.input_folder, args.input_mbox,
+                    args.input_maildir)
+        created_filenames, uncreated_filenames = create_csvs(email_sources, args.prefix, args.force,
+                args.no_visualize, args.workers, args.geo_cache, args.geo_cache_ttl,
+                args.geo_concurrency, args.tor_snapshots, args.tor_max_age, args.tor_history,
+                args.geo_db, args.incremental, not args.no_sort, stats,
+                ipinfo_api_key=args.ipinfo_api_key)
+        if args.binary_format is not None:
+            write_binary_copies(created_filenames, args.binary_format, stats)
+        if args.incremental:
+            # Also the csvs of earlier runs, not just those with new hits
+            created_filenames = get_existing_csv_filenames(
+                    ProcessedEmailManifest(get_manifest_path(args.prefix)))
     else:
         created_filenames = []
         uncreated_filenames = Counter()
@@ -340,16 +1097,171 @@ def main():
     if args.input_csvs is not None:
         # Only draw files user explicitly selected - or default to all
         created_filenames = args.input_csvs
+    visualize_csvs(created_filenames + list(uncreated_filenames.keys()), args, grid, stats,
+            hit_filter)
+
+
+def watch_emails(args, grid, stats, hit_filter=None):
+    """Runs the watch mode: handles emails as they arrive, until interrupted.
+    As in an incremental run, the hits of new emails are enriched and
+    appended to the csvs. Then the figures of the tokens that got new hits
+    are rendered again, together with all_tokens, which are all rendered at
+    the start. Times of the hit_filter that are relative to now are
+    evaluated again for every render. Hits are appended in the order their
+    emails arrive, and the csvs are sorted once watching stops. They stay
+    marked as unsorted until then, so if the watcher is killed, the next
+    run that sorts finishes them"""
+    if hit_filter is not None:
+        from hit_store import HitFilter
+    set_up_lookups(args.prefix, args.geo_cache, args.geo_cache_ttl,
+            args.geo_concurrency, args.tor_snapshots, args.tor_max_age,
+            args.tor_history, args.geo_db, args.ipinfo_api_key)
+    manifest = ProcessedEmailManifest(get_manifest_path(args.prefix))
+    watcher = EmailInputWatcher(args.input_folder, args.input_mbox, args.input_maildir,
+            args.poll_interval)
+    print("Watching for new emails, stop with Ctrl+C")
+    try:
+        # Emails that arrived while not watching
+        email_sources = watcher.get_new_sources()
+        render_all = True
+        while True:
+            TokenHitEnrichmentClass.tor_exits.expire_outdated()
+            created_filenames, _ = build_data_csvs(email_sources, args.prefix,
+                    workers=args.workers, incremental=True, sort=False, stats=stats,
+                    manifest=manifest, mark_unsorted=True)
+            if len(created_filenames) > 0:
+                print(f"New token hits in {', '.join(created_filenames)}")
+
+            csv_filenames = args.input_csvs
+            if csv_filenames is None:
+                csv_filenames = get_existing_csv_filenames(manifest)
+            if not args.no_visualize and len(csv_filenames) > 0 and \
+                    (render_all or len(created_filenames) > 0):
+                if hit_filter is not None:
+                    # Moves e.g. the window of --since 7d along
+                    hit_filter = HitFilter.from_arguments(args.since, args.until, args.where)
+                visualize_csvs(csv_filenames, args, grid, stats, hit_filter,
+                        None if render_all else created_filenames)
+                render_all = False
+            email_sources = watcher.wait_for_new_sources()
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.close()
+        finish_lookups(stats)
+        sort_marked_csvs(args.prefix, manifest)
+        manifest.save()
+
+
+def visualize_csvs(csv_filenames, args, grid, stats, hit_filter=None,
+        changed_csv_filenames=None):
+    """Draws the graphs of all given csvs as requested by the arguments.
+    With a hit_filter (see hit_store.HitFilter) only the matching hits
+    are drawn. If changed_csv_filenames is given only the figures of these
+    csvs, and all_tokens, are rendered again"""
+    if len(csv_filenames) == 0:
+        print("No csvs to draw")
+        return
+    import analysis
+
+    # Only load what the graphs need
+    default_graph = analysis.build_default_graph()
+    with stats.stage("load"):
+        if hit_filter is None:
+            list_of_tokenToGraph = load_tokens_to_graph(csv_filenames, args,
+                    default_graph, stats)
+        else:
+            list_of_tokenToGraph = load_filtered_tokens_to_graph(csv_filenames, args,
+                    hit_filter, default_graph, stats)
+    if hit_filter is not None and len(list_of_tokenToGraph) == 0:
+        print("No token hits match --since, --until and --where")
+        return
+
+    with stats.stage("render"):
+        rendered_filenames = analysis.run_analyses(list_of_tokenToGraph, args.output_dir,
+                args.formats, args.dpi, grid, args.workers, args.separate_graphs,
+                args.time_bucket, args.max_points, changed_csv_filenames)
+    stats.count("files_rendered", len(rendered_filenames))
+    if len(rendered_filenames) > 0:
+        print("Rendered these graphs:")
+        for filename in rendered_filenames:
+            print(filename)
+
 
+def load_tokens_to_graph(csv_filenames, args, default_graph, stats):
+    """Returns a TokenToGraph for every csv, with the counts of
+    the aggregation cache unless it is turned off"""
+    import analysis
+    import token_table
+    from aggregation_cache import AggregationCache
 
     list_of_tokenToGraph = []
+    required_columns = default_graph.get_required_columns()
+    aggregation_cache = None
+    if required_columns is not None and not args.no_aggregation_cache:
+        aggregation_cache_path = args.aggregation_cache
+        if aggregation_cache_path is None:
+            aggregation_cache_path = get_default_aggregation_cache_path(args.prefix)
+        aggregation_cache = AggregationCache(aggregation_cache_path)
     # Create list of TokenToDraw that is then passed to visualization
-    for csv_filename in created_filenames + list(uncreated_filenames.keys()):
-        list_of_all_tokenhits = create_list_from_csv(csv_filename)
-        token_to_graph = analysis.TokenToGraph(csv_filename, list_of_all_tokenhits)
+    for csv_filename in csv_filenames:
+        if aggregation_cache is not None:
+            # Graphs only need the counts, which are usually cached
+            count_table = aggregation_cache.get_count_table(csv_filename,
+                    *default_graph.get_counted_columns(), args.binary_format)
+            token_to_graph = analysis.TokenToGraph(csv_filename, count_table=count_table)
+        else:
+            table_of_all_tokenhits = token_table.load_token_table(csv_filename,
+                    required_columns, args.binary_format)
+            token_to_graph = analysis.TokenToGraph(csv_filename, table=table_of_all_tokenhits)
+            stats.count("token_hits_loaded", len(table_of_all_tokenhits))
         list_of_tokenToGraph.append(token_to_graph)
-
-    analysis.run_analyses(list_of_tokenToGraph)
+    if aggregation_cache is not None:
+        stats.count("aggregation_cache_hits", aggregation_cache.hits)
+        stats.count("aggregation_cache_appends", aggregation_cache.appends)
+        stats.count("aggregation_cache_misses", aggregation_cache.misses)
+        aggregation_cache.close()
+    return list_of_tokenToGraph
+
+
+def load_filtered_tokens_to_graph(csv_filenames, args, hit_filter, default_graph, stats):
+    """Returns a TokenToGraph with the hits that match the filter for every
+    csv that has any, read from the hit store. Counts depend on the
+    filter, so the aggregation cache is not used"""
+    import analysis
+    from hit_store import HitStore
+
+    hit_store_path = args.hit_store
+    if hit_store_path is None:
+        hit_store_path = get_default_hit_store_path(args.prefix)
+    hit_store = HitStore(hit_store_path)
+    list_of_tokenToGraph = []
+    for csv_filename in csv_filenames:
+        table_of_matching_tokenhits = hit_store.select(csv_filename, hit_filter,
+                default_graph.get_required_columns(), args.binary_format)
+        if table_of_matching_tokenhits is None or len(table_of_matching_tokenhits) == 0:
+            continue
+        list_of_tokenToGraph.append(analysis.TokenToGraph(csv_filename,
+            table=table_of_matching_tokenhits))
+        stats.count("token_hits_loaded", len(table_of_matching_tokenhits))
+    stats.count("hit_store_segments_built", hit_store.segments_built)
+    stats.count("hit_store_segments_reused", hit_store.segments_reused)
+    return list_of_tokenToGraph
+
+
+def report_pipeline_stats(stats, args):
+    """Prints and writes the stats as requested by --profile,
+    --stats_json and --profile_stage"""
+    if args.profile:
+        stats.print_summary()
+    if args.stats_json is not None:
+        stats.write_json(args.stats_json)
+    if args.profile_stage is not None:
+        profile_output = args.profile_output
+        if profile_output is None:
+            profile_output = args.profile_stage + ".prof"
+        stats.dump_profile(profile_output)
+        print(f"Wrote cProfile stats of stage {args.profile_stage} to {profile_output}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""Implements a manifest of already processed emails, so reruns over
+a growing email folder only need to parse the emails that are new"""
+import os
+import json
+import hashlib
+
+# Bytes before the recorded size of a csv that have to be unchanged
+# before it is truncated back to that size
+CSV_TAIL_SIZE = 4096
+
+
+def hash_csv_tail(csv_filename, size, tail_size=CSV_TAIL_SIZE):
+    """Returns the sha256 hex digest of the last tail_size bytes of
+    the first size bytes of a csv"""
+    with open(csv_filename, "rb") as csv_file:
+        csv_file.seek(max(0, size - tail_size))
+        return hashlib.sha256(csv_file.read(min(size, tail_size))).hexdigest()
+
+
+class ProcessedEmailManifest:
+    """Records every processed email source (see email_sources) as
+    key -> size, mtime and content hash. An email counts as processed if
+    size and mtime are unchanged, or, if only the mtime changed (e.g. after
+    copying the folder) or it has none (messages of an mbox), if the
+    content hash is unchanged. For canary emails the csv their hit was
+    written to is recorded as well.
+    For every csv the size it had once all hits of the processed emails were
+    written is recorded too (see record_csv), so rows of emails that are not
+    in the manifest, because a run was interrupted, can be cut off again.
+    Stored as json lines file, save() only appends the entries recorded
+    since the last save, so it can be called after every batch of emails"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.csv_states = {}
+        self._unsaved_entries = []
+        self._unsaved_csv_states = []
+
+        number_of_lines = 0
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of an interrupted save
+                        continue
+                    if "csv_state" in entry:
+                        self.csv_states[entry["csv_state"]["path"]] = entry["csv_state"]
+                    else:
+                        self.entries[entry["path"]] = entry
+                    number_of_lines += 1
+        if number_of_lines > 2 * (len(self.entries) + len(self.csv_states)):
+            self._compact()
+
+    def is_processed(self, email_source):
+        entry = self.entries.get(email_source.key)
+        if entry is None:
+            return False
+        if email_source.get_size() != entry["size"]:
+            return False
+        mtime = email_source.get_mtime()
+        if mtime is not None and mtime == entry["mtime"]:
+            return True
+        if email_source.get_sha256() != entry["sha256"]:
+            return False
+        if mtime != entry["mtime"]:
+            entry["mtime"] = mtime
+            self._unsaved_entries.append(entry)
+        return True
+
+    def mark_processed(self, email_source, csv_filename=None):
+        entry = {"path": email_source.key, "size": email_source.get_size(),
+                "mtime": email_source.get_mtime(), "sha256": email_source.get_sha256()}
+        if csv_filename is not None:
+            entry["csv"] = csv_filename
+        self.entries[email_source.key] = entry
+        self._unsaved_entries.append(entry)
+
+    @property
+    def csv_filenames(self):
+        """All csvs that hits of processed emails were written to"""
+        return sorted({entry["csv"] for entry in self.entries.values() if "csv" in entry})
+
+    def record_csv(self, csv_filename):
+        """Records the current size of a csv, together with a hash of its
+        last bytes, to be called once the hits of all emails marked as
+        processed are written to it"""
+        size = os.path.getsize(csv_filename)
+        state = {"path": csv_filename, "size": size,
+                "tail_sha256": hash_csv_tail(csv_filename, size)}
+        self.csv_states[csv_filename] = state
+        self._unsaved_csv_states.append(state)
+
+    def truncate_csvs(self):
+        """Cuts off rows that were appended to a csv after its size was last
+        recorded, i.e. hits of emails an interrupted run did not get to
+        mark as processed, as these emails are read again.
+        Csvs that were changed in other ways are left as they are.
+        Returns the truncated csvs"""
+        truncated_csv_filenames = []
+        for csv_filename, state in self.csv_states.items():
+            if not os.path.exists(csv_filename) or \
+                    os.path.getsize(csv_filename) <= state["size"]:
+                continue
+            if hash_csv_tail(csv_filename, state["size"]) != state["tail_sha256"]:
+                continue
+            with open(csv_filename, "r+b") as csv_file:
+                csv_file.truncate(state["size"])
+            truncated_csv_filenames.append(csv_filename)
+        return truncated_csv_filenames
+
+    def save(self):
+        """Appends all entries and csv sizes recorded since the last save.
+        The csv sizes come first, so if a save is interrupted an email is
+        never recorded as processed without its hits being counted in them"""
+        lines = [json.dumps({"csv_state": state}) + "\n" for state in self._unsaved_csv_states]
+        lines += [json.dumps(entry) + "\n" for entry in self._unsaved_entries]
+        if len(lines) == 0:
+            return
+        with open(self.path, "a") as manifest_file:
+            manifest_file.write("".join(lines))
+        self._unsaved_entries = []
+        self._unsaved_csv_states = []
+
+    def _compact(self):
+        """Rewrites the manifest with one line per email and csv, replacing
+        the old one only once the new one is complete"""
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            for state in self.csv_states.values():
+                manifest_file.write(json.dumps({"csv_state": state}) + "\n")
+            for entry in self.entries.values():
+                manifest_file.write(json.dumps(entry) + "\n")
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,142 @@
+"""Implements optional instrumentation of the pipeline: wall time per
+stage, counters, a live progress rate and cProfile dumps of a single stage.
+Turned off, all of it is replaced by DisabledPipelineStats, whose methods
+do nothing"""
+import sys
+import json
+import time
+import cProfile
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Stages of the pipeline, see build_data_csvs and main
+STAGES = ["scan", "parse", "build", "geo_lookup", "tor_check", "write", "sort",
+        "load", "render"]
+# Seconds between two updates of the progress line
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+
+class PipelineStats:
+    """Records the wall time spent in every stage and counts of processed items.
+    Stages can be nested, e.g. parsing is driven by building hits, and
+    time spent in an inner stage only counts for the inner one, so the
+    times of all stages add up to the time spent in stages overall.
+    If a profile_stage is given that stage runs under cProfile.
+    With show_progress a line with the number of parsed emails and hits and
+    their rate is kept up to date on stderr"""
+
+    def __init__(self, profile_stage=None, show_progress=False):
+        self.stage_seconds = Counter()
+        self.counts = Counter()
+        self.profile_stage = profile_stage
+        self.profiler = None if profile_stage is None else cProfile.Profile()
+        self.show_progress = show_progress
+
+        self._started = time.perf_counter()
+        self._last_progress = self._started
+        self._stage_stack = []
+        self._stage_started = None
+
+    @property
+    def total_seconds(self):
+        return time.perf_counter() - self._started
+
+    @contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if len(self._stage_stack) > 0:
+            # Pause the outer stage
+            self.stage_seconds[self._stage_stack[-1]] += now - self._stage_started
+        self._stage_stack.append(name)
+        self._stage_started = now
+        if name == self.profile_stage:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if name == self.profile_stage:
+                self.profiler.disable()
+            now = time.perf_counter()
+            self.stage_seconds[name] += now - self._stage_started
+            self._stage_stack.pop()
+            self._stage_started = now
+
+    def iterate(self, name, iterable):
+        """Yields the items of iterable, counting the time spent
+        producing them, e.g. in a generator, as stage name"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def report_progress(self):
+        """Updates the progress line, at most every PROGRESS_INTERVAL_SECONDS"""
+        if not self.show_progress:
+            return
+        now = time.perf_counter()
+        if now - self._last_progress < PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_progress = now
+        seconds = now - self._started
+        print(f"\r{self.counts['emails_parsed']} emails parsed "
+                f"({self.counts['emails_parsed'] / seconds:.0f}/s), "
+                f"{self.counts['token_hits']} hits written "
+                f"({self.counts['token_hits'] / seconds:.0f}/s)",
+                end="", file=sys.stderr, flush=True)
+
+    def to_dict(self):
+        total_seconds = self.total_seconds
+        return {"total_seconds": total_seconds,
+                "stage_seconds": dict(self.stage_seconds),
+                "counts": dict(self.counts),
+                "emails_per_second": self.counts["emails_parsed"] / total_seconds,
+                "hits_per_second": self.counts["token_hits"] / total_seconds}
+
+    def write_json(self, path):
+        with open(path, "w") as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2)
+
+    def dump_profile(self, path):
+        """Writes the cProfile stats of the profiled stage, e.g. for pstats or snakeviz"""
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+
+    def print_summary(self):
+        if self.show_progress:
+            # End the progress line
+            print(file=sys.stderr)
+        stats = self.to_dict()
+        print(f"Finished in {stats['total_seconds']:.2f}s, "
+                f"{stats['hits_per_second']:.1f} hits per second", file=sys.stderr)
+        for stage, seconds in sorted(self.stage_seconds.items(), key=lambda item: -item[1]):
+            print(f"{stage:>12}: {seconds:8.2f}s", file=sys.stderr)
+        for name, count in sorted(self.counts.items()):
+            print(f"{name:>30}: {count}", file=sys.stderr)
+
+
+class DisabledPipelineStats:
+    """Stands in for PipelineStats when instrumentation is turned off"""
+    _no_stage = nullcontext()
+
+    def stage(self, name):
+        return self._no_stage
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def count(self, name, amount=1):
+        pass
+
+    def report_progress(self):
+        pass
+
+
+# Used by functions that are not given any stats
+DISABLED = DisabledPipelineStats()
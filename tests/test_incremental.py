@@ -0,0 +1,180 @@
+"""Checks that incremental runs over a growing email folder give the same
+csvs as a single run over all emails, also for hits that are identical
+row by row, after a run that was interrupted between two batches or
+before it recorded any of its emails, and over an mbox that messages
+were removed from. Csvs an incremental run did not create are only
+replaced with --force, and an interrupted run that is not incremental
+leaves no csvs behind.
+
+Example call:
+python -m unittest discover tests
+"""
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_FOLDER = os.path.dirname(TEST_FOLDER)
+sys.path.insert(0, REPOSITORY_FOLDER)
+sys.path.insert(0, os.path.join(REPOSITORY_FOLDER, "benchmarks"))
+
+from generators import generate_hits, write_email_folder, write_mbox
+from email_sources import list_email_sources
+from manifest import ProcessedEmailManifest
+import main
+import pandas as pd
+
+NUMBER_OF_HITS = 40
+
+
+def generate_hits_with_duplicate(number_of_hits):
+    """Returns generated hits where the last hit of the first half is
+    repeated as the first hit of the second half, as two alert emails
+    from the same scanner in the same second would be"""
+    hits = generate_hits(number_of_hits - 1)
+    half = number_of_hits // 2
+    return pd.concat([hits.iloc[:half], hits.iloc[half - 1:]], ignore_index=True)
+
+
+def read_csvs(base_path_to_output_csv):
+    """Returns the content of every csv with this prefix, by name"""
+    contents = {}
+    for csv_filename in sorted(glob.glob(glob.escape(base_path_to_output_csv) + "*.csv")):
+        with open(csv_filename) as csv_file:
+            contents[os.path.basename(csv_filename)] = csv_file.read()
+    return contents
+
+
+class IncrementalRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.hits = generate_hits_with_duplicate(NUMBER_OF_HITS)
+        self.all_emails = os.path.join(self.folder, "all_emails")
+        write_email_folder(self.all_emails, self.hits)
+
+        self.expected_prefix = os.path.join(self.folder, "expected", "")
+        os.makedirs(self.expected_prefix)
+        self.run_over(self.all_emails, self.expected_prefix, incremental=False)
+        self.expected = read_csvs(self.expected_prefix)
+
+        self.growing_emails = os.path.join(self.folder, "growing_emails")
+        self.prefix = os.path.join(self.folder, "incremental", "")
+        os.makedirs(self.growing_emails)
+        os.makedirs(self.prefix)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_over(self, email_folder, base_path_to_output_csv, incremental=True, force=False,
+            mbox=None):
+        email_sources = list_email_sources(email_folder, mbox)
+        return main.build_data_csvs(email_sources, base_path_to_output_csv,
+                force=force, incremental=incremental, enrich=False)
+
+    def add_emails(self, start, stop):
+        for filename in sorted(os.listdir(self.all_emails))[start:stop]:
+            shutil.copy2(os.path.join(self.all_emails, filename), self.growing_emails)
+
+    def test_identical_hits_are_kept(self):
+        duplicate = self.hits.iloc[NUMBER_OF_HITS // 2]
+        expected_csv = self.expected[duplicate.reminder + ".csv"]
+        self.assertEqual(expected_csv.count(f'"{duplicate.timestamp}","{duplicate.src_ip}"'), 2)
+
+        self.add_emails(0, NUMBER_OF_HITS // 2)
+        self.run_over(self.growing_emails, self.prefix)
+        self.add_emails(NUMBER_OF_HITS // 2, NUMBER_OF_HITS)
+        self.run_over(self.growing_emails, self.prefix)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+        # Nothing new, nothing changes
+        self.run_over(self.growing_emails, self.prefix)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+    def test_rows_of_interrupted_run_are_removed(self):
+        self.add_emails(0, NUMBER_OF_HITS // 2)
+        self.run_over(self.growing_emails, self.prefix)
+
+        # Hits an interrupted run wrote before marking their emails as processed
+        csv_filename = sorted(glob.glob(self.prefix + "*.csv"))[0]
+        with open(csv_filename) as csv_file:
+            rows = csv_file.readlines()[1:]
+        with open(csv_filename, "a") as csv_file:
+            csv_file.writelines(rows)
+
+        self.add_emails(NUMBER_OF_HITS // 2, NUMBER_OF_HITS)
+        self.run_over(self.growing_emails, self.prefix)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+    def test_rows_of_run_interrupted_before_recording_emails_are_removed(self):
+        self.add_emails(0, NUMBER_OF_HITS)
+        mark_processed = ProcessedEmailManifest.mark_processed
+
+        def interrupt_at_first_canary_email(manifest, email_source, csv_filename=None):
+            if csv_filename is not None:
+                raise KeyboardInterrupt
+            mark_processed(manifest, email_source, csv_filename)
+
+        # The hits of the first batch are written, but none of its emails recorded
+        with mock.patch.object(ProcessedEmailManifest, "mark_processed",
+                interrupt_at_first_canary_email):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_over(self.growing_emails, self.prefix)
+        self.assertNotEqual(read_csvs(self.prefix), {})
+
+        self.run_over(self.growing_emails, self.prefix)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+    def test_csvs_of_run_that_was_not_incremental_need_force(self):
+        self.add_emails(0, NUMBER_OF_HITS)
+        self.run_over(self.growing_emails, self.prefix, incremental=False)
+
+        _, uncreated_csv_filenames = self.run_over(self.growing_emails, self.prefix)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+        self.assertEqual(len(uncreated_csv_filenames), len(self.expected))
+
+        self.run_over(self.growing_emails, self.prefix, force=True)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+        # Recorded now, so new hits are appended
+        self.run_over(self.growing_emails, self.prefix)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+    def test_removed_mbox_messages_dont_change_later_ones(self):
+        mbox_path = os.path.join(self.folder, "alerts.mbox")
+        write_mbox(mbox_path, self.hits)
+        self.run_over(None, self.prefix, mbox=mbox_path)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+        # Later messages move to other offsets, their hits are still known
+        write_mbox(mbox_path, self.hits.iloc[1:])
+        self.run_over(None, self.prefix, mbox=mbox_path)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+    def test_interrupted_run_that_is_not_incremental_leaves_no_csvs(self):
+        self.add_emails(0, NUMBER_OF_HITS)
+        flush = main.TokenHitCsvWriters.flush
+        flushes = []
+
+        def interrupt_after_second_flush(writers):
+            flush(writers)
+            flushes.append(writers)
+            if len(flushes) == 2:
+                raise KeyboardInterrupt
+
+        with mock.patch.object(main, "PIPELINE_BATCH_SIZE", 5), \
+                mock.patch.object(main.TokenHitCsvWriters, "flush",
+                    interrupt_after_second_flush):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_over(self.growing_emails, self.prefix, incremental=False)
+        self.assertEqual(read_csvs(self.prefix), {})
+
+        self.run_over(self.growing_emails, self.prefix, incremental=False)
+        self.assertEqual(read_csvs(self.prefix), self.expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Checks IpinfoResolver against the local stub of ipinfo.io: requests
+answered with HTTP 429 are retried, after Retry-After if given, and geo
+info from the batch endpoint is written exactly as the single ip endpoint
+returns it.
+
+Example call:
+python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_FOLDER = os.path.dirname(TEST_FOLDER)
+sys.path.insert(0, REPOSITORY_FOLDER)
+sys.path.insert(0, os.path.join(REPOSITORY_FOLDER, "benchmarks"))
+
+from generators import generate_hits
+from stub_servers import StubServer
+from enrichment import IpinfoResolver
+
+NUMBER_OF_HITS = 50
+
+
+def build_resolver(stub_server, batch=True, max_retries=5):
+    url_of_ipinfo_batch = stub_server.url + "/batch?token={token}" if batch else None
+    return IpinfoResolver(stub_server.url + "/{ip}?token={token}", "test",
+            url_of_ipinfo_batch, max_concurrency=1, max_retries=max_retries,
+            backoff_seconds=0.01)
+
+
+class IpinfoResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ips = sorted(set(generate_hits(NUMBER_OF_HITS)["src_ip"]))
+
+    def test_rate_limited_batch_is_retried_after_retry_after(self):
+        with StubServer(rate_limited_requests=2, retry_after="0") as stub_server:
+            resolver = build_resolver(stub_server)
+            results = resolver.resolve(self.ips)
+        self.assertEqual(resolver.requests_sent, 3)
+        self.assertEqual(sorted(results), self.ips)
+        self.assertTrue(all(ok for _, ok in results.values()))
+
+    def test_rate_limited_single_lookup_is_retried_with_backoff(self):
+        with StubServer(rate_limited_requests=2) as stub_server:
+            resolver = build_resolver(stub_server, batch=False)
+            results = resolver.resolve(self.ips[:1])
+        self.assertEqual(resolver.requests_sent, 3)
+        self.assertTrue(results[self.ips[0]][1])
+
+    def test_last_rate_limited_answer_is_a_failure(self):
+        with StubServer(rate_limited_requests=3) as stub_server:
+            resolver = build_resolver(stub_server, batch=False, max_retries=2)
+            geo_info, ok = resolver.resolve(self.ips[:1])[self.ips[0]]
+        self.assertEqual(resolver.requests_sent, 3)
+        self.assertFalse(ok)
+        self.assertIn("error", geo_info)
+
+    def test_batch_and_single_geo_info_are_equal(self):
+        with StubServer(pretty=True) as stub_server:
+            batch_results = build_resolver(stub_server).resolve(self.ips)
+            single_results = build_resolver(stub_server, batch=False).resolve(self.ips)
+        self.assertEqual(batch_results, single_results)
+        # Pretty printed, without the newlines
+        self.assertIn('{  "ip": ', single_results[self.ips[0]][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
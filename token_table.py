@@ -0,0 +1,209 @@
+"""Loads token csvs into typed, columnar tables, as an alternative
+to building a TokenHit object for every row"""
+import io
+import os
+import json
+import functools
+
+import numpy as np
+import pandas as pd
+from user_agents import parse
+
+CSV_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S (UTC)"
+
+# Maps the csv header to the column names of the table, which are
+# the attribute names of TokenHit
+CSV_COLUMNS = {"Timestamp": "timestamp", "src_ip": "src_ip",
+        "input_channel": "input_channel", "geo_info": "geo_info",
+        "is_tor_relay": "is_tor_relay", "referer": "referer",
+        "location": "location", "useragent": "useragent"}
+
+# Few distinct values repeated over many hits, stored as categoricals
+CATEGORICAL_COLUMNS = ["src_ip", "input_channel", "geo_info",
+        "referer", "location", "useragent"]
+
+# Columns add_derived_columns adds, which graph definitions can read by name
+GEO_COLUMNS = ["country", "region"]
+USERAGENT_COLUMNS = ["browser_family", "os_family", "is_mobile"]
+DERIVED_COLUMNS = GEO_COLUMNS + USERAGENT_COLUMNS
+
+# Bounds the memo of decoded strings, scanner traffic has few distinct ones
+DECODE_CACHE_SIZE = 1 << 16
+
+# File extensions of the binary formats tables can be stored in
+BINARY_FORMATS = {"parquet": ".parquet", "feather": ".feather"}
+
+
+def load_token_table(filename, columns=None, binary_format=None):
+    """Takes a csv file in the format we produce and returns a
+    DataFrame with one row per token hit. Timestamps are parsed in a single
+    vectorized pass, is_tor_relay is boolean, and all string columns
+    are categoricals. Only the given columns are returned, if any, derived
+    columns (see add_derived_columns) are added if requested.
+    With a binary_format (one of BINARY_FORMATS) the table is read from a
+    binary copy next to the csv, which includes the derived columns and only
+    the requested columns are read from. The copy is created, or recreated
+    if the csv is newer. Binary files can also be passed as filename"""
+    for file_format, extension in BINARY_FORMATS.items():
+        if filename.endswith(extension):
+            return read_binary_table(filename, file_format, columns)
+
+    if binary_format is None:
+        table = _read_csv_table(filename)
+        if columns is None:
+            return table
+        if any(column in DERIVED_COLUMNS for column in columns):
+            add_derived_columns(table)
+        return table[columns]
+
+    binary_path = get_binary_path(filename, binary_format)
+    if (os.path.exists(binary_path)
+            and os.path.getmtime(binary_path) >= os.path.getmtime(filename)):
+        available_columns = read_binary_column_names(binary_path, binary_format)
+        if columns is None or all(column in available_columns for column in columns):
+            return read_binary_table(binary_path, binary_format, columns)
+
+    table = write_binary_table(_read_csv_table(filename), binary_path, binary_format)
+    return table if columns is None else table[columns]
+
+
+def load_token_table_tail(filename, offset, columns=None):
+    """Like load_token_table for a csv, but only reads the rows
+    from byte offset on, which must be the start of a row"""
+    with open(filename, "rb") as csv_file:
+        header = csv_file.readline()
+        csv_file.seek(max(offset, len(header)))
+        table = _read_csv_table(io.BytesIO(header + csv_file.read()))
+    if columns is None:
+        return table
+    if any(column in DERIVED_COLUMNS for column in columns):
+        add_derived_columns(table)
+    return table[columns]
+
+
+def _read_csv_table(filename):
+    dtypes = {csv_column: "category" for csv_column, column in CSV_COLUMNS.items()
+            if column in CATEGORICAL_COLUMNS}
+    dtypes["Timestamp"] = str
+    dtypes["is_tor_relay"] = str
+    table = pd.read_csv(filename, dtype=dtypes, keep_default_na=False)
+    table = table.rename(columns=CSV_COLUMNS)
+
+    table["timestamp"] = pd.to_datetime(table["timestamp"], format=CSV_TIMESTAMP_FORMAT)
+    table["is_tor_relay"] = table["is_tor_relay"].str.lower() == "true"
+    return table
+
+
+def get_binary_path(csv_filename, binary_format):
+    """The binary copy of a csv lives next to it, e.g.
+    webpage.csv is stored as webpage.parquet"""
+    return os.path.splitext(csv_filename)[0] + BINARY_FORMATS[binary_format]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Binary table formats require the pyarrow package") from error
+    return pyarrow
+
+
+def write_binary_table(table, path, binary_format):
+    """Adds the derived columns to the table and writes it in the binary format.
+    The file is replaced only once it is complete. Returns the table"""
+    pyarrow = _import_pyarrow()
+    add_derived_columns(table)
+    arrow_table = pyarrow.Table.from_pandas(table, preserve_index=False)
+
+    temporary_path = path + ".tmp"
+    if binary_format == "parquet":
+        pyarrow.parquet.write_table(arrow_table, temporary_path)
+    else:
+        pyarrow.feather.write_feather(arrow_table, temporary_path)
+    os.replace(temporary_path, path)
+    return table
+
+
+def read_binary_column_names(path, binary_format):
+    pyarrow = _import_pyarrow()
+    if binary_format == "parquet":
+        return pyarrow.parquet.read_schema(path, memory_map=True).names
+    with pyarrow.memory_map(path) as source:
+        return pyarrow.ipc.open_file(source).schema.names
+
+
+def read_binary_table(path, binary_format, columns=None):
+    """Reads only the given columns of a table written by write_binary_table,
+    memory mapping the file. Categoricals, booleans and timestamps
+    keep their types"""
+    pyarrow = _import_pyarrow()
+    if binary_format == "parquet":
+        arrow_table = pyarrow.parquet.read_table(path, columns=columns, memory_map=True)
+    else:
+        arrow_table = pyarrow.feather.read_table(path, columns=columns, memory_map=True)
+    return arrow_table.to_pandas()
+
+
+def table_from_token_hits(list_of_token_hits):
+    """Returns a table in the format of load_token_table
+    for a list of TokenHits"""
+    table = pd.DataFrame({column: [getattr(hit, column) for hit in list_of_token_hits]
+            for column in CSV_COLUMNS.values()})
+    table["timestamp"] = pd.to_datetime(table["timestamp"])
+    table["is_tor_relay"] = table["is_tor_relay"].astype(str).str.lower() == "true"
+    for column in CATEGORICAL_COLUMNS:
+        table[column] = table[column].astype("category")
+    return table
+
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def decode_geo_info(geo_info):
+    """Returns (country, region) of a geo info json string.
+    Unknown for fields missing in the json, e.g. for bogons or errors"""
+    try:
+        decoded_geo_info = json.loads(geo_info)
+    except (TypeError, ValueError):
+        return ("Unknown", "Unknown")
+    if not isinstance(decoded_geo_info, dict):
+        return ("Unknown", "Unknown")
+    return tuple("Unknown" if decoded_geo_info.get(key) is None else decoded_geo_info[key]
+            for key in GEO_COLUMNS)
+
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def decode_useragent(useragent):
+    """Returns (browser family, os family, is mobile) of a user agent string"""
+    parsed_useragent = parse(useragent)
+    return (parsed_useragent.browser.family, parsed_useragent.os.family,
+            parsed_useragent.is_mobile)
+
+
+def add_derived_columns(table):
+    """Derivation stage: decodes geo info and user agents and adds the
+    results as the columns in DERIVED_COLUMNS. Every distinct geo info
+    and user agent string is decoded once, and the results are spread
+    over all rows by their category codes. Does nothing for columns
+    the table already has"""
+    for source_column, derived_columns, decode in (
+            ("geo_info", GEO_COLUMNS, decode_geo_info),
+            ("useragent", USERAGENT_COLUMNS, decode_useragent)):
+        if all(column in table.columns for column in derived_columns):
+            continue
+        column = table[source_column]
+        if not isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype("category")
+        codes = column.cat.codes.to_numpy()
+        decoded_categories = [decode(value) for value in column.cat.categories]
+
+        for position, derived_column in enumerate(derived_columns):
+            values_of_categories = [decoded[position] for decoded in decoded_categories]
+            if derived_column == "is_mobile":
+                table[derived_column] = np.array(values_of_categories, dtype=bool)[codes]
+                continue
+            derived_codes, derived_categories = pd.factorize(np.array(values_of_categories, dtype=object))
+            table[derived_column] = pd.Categorical.from_codes(
+                    derived_codes[codes], categories=derived_categories)
+    return table
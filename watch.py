@@ -0,0 +1,141 @@
+"""Implements watching email inputs for newly arrived emails, so a
+long running process only handles new emails, see main.watch_emails"""
+import os
+import time
+import logging
+import threading
+
+from email_sources import MboxIndex, list_email_sources
+
+# Seconds between two checks of the watched inputs for changes
+DEFAULT_POLL_SECONDS = 1.0
+# Emails and mboxes modified more recently may still be written to,
+# they are reported once they settled
+SETTLE_SECONDS = 0.5
+
+
+def _import_watchdog():
+    try:
+        import watchdog.events
+        import watchdog.observers
+    except ImportError:
+        return None
+    return watchdog
+
+
+class EmailInputWatcher:
+    """Reports the email sources (see email_sources) of a folder, mbox or
+    Maildir that it did not report before, starting with all existing ones.
+    Inputs are only listed again if a filesystem notification arrived, or
+    if the mtime or size of a watched folder or mbox changed since the last
+    check, so waiting for new emails costs next to no cpu. Notifications are
+    used if the watchdog package is installed, otherwise inputs are checked
+    every poll_seconds"""
+
+    def __init__(self, input_folder=None, input_mbox=None, input_maildir=None,
+            poll_seconds=DEFAULT_POLL_SECONDS):
+        self.input_folder = input_folder
+        self.input_mbox = input_mbox
+        self.input_maildir = input_maildir
+        self.poll_seconds = poll_seconds
+
+        self.watched_paths = []
+        if input_folder is not None:
+            self.watched_paths.append(input_folder)
+        if input_mbox is not None:
+            self.watched_paths.append(input_mbox)
+        if input_maildir is not None:
+            # New messages are delivered to new/, and moved to cur/ once seen
+            self.watched_paths += [os.path.join(input_maildir, "new"),
+                    os.path.join(input_maildir, "cur")]
+
+        # Only the messages appended to the mbox are indexed again, if it grew
+        self._mbox_index = None if input_mbox is None else MboxIndex(input_mbox)
+        self._reported_keys = set()
+        self._last_signature = None
+        # Set if an input has to be listed again, e.g. after a notification
+        self._changed = threading.Event()
+        self._changed.set()
+        self._observer = self._start_observer()
+
+    def _start_observer(self):
+        watchdog = _import_watchdog()
+        if watchdog is None:
+            logging.info("watchdog is not installed, checking for new emails "
+                    "every %.1fs", self.poll_seconds)
+            return None
+
+        changed = self._changed
+
+        class ChangeHandler(watchdog.events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                changed.set()
+
+        observer = watchdog.observers.Observer()
+        for path in self.watched_paths:
+            # Files can only be watched through their folder
+            folder = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+            observer.schedule(ChangeHandler(), folder, recursive=False)
+        observer.daemon = True
+        observer.start()
+        return observer
+
+    def _get_signature(self):
+        signature = []
+        for path in self.watched_paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        return signature
+
+    def _is_settled(self, email_source, now):
+        mtime = email_source.get_mtime()
+        if mtime is None:
+            # Messages of an mbox, which settles as a whole
+            mtime = os.path.getmtime(self.input_mbox)
+        return now - mtime >= SETTLE_SECONDS
+
+    def get_new_sources(self):
+        """Returns the email sources that arrived since the last call
+        and settled, without waiting"""
+        signature = self._get_signature()
+        if not self._changed.is_set() and signature == self._last_signature:
+            return []
+        self._changed.clear()
+        self._last_signature = signature
+
+        now = time.time()
+        new_sources = []
+        email_sources = list_email_sources(self.input_folder, None, self.input_maildir)
+        if self._mbox_index is not None:
+            email_sources += self._mbox_index.update()
+        for email_source in email_sources:
+            if email_source.key in self._reported_keys:
+                continue
+            if not self._is_settled(email_source, now):
+                # Check again once it settled
+                self._changed.set()
+                continue
+            new_sources.append(email_source)
+            self._reported_keys.add(email_source.key)
+        return new_sources
+
+    def wait_for_new_sources(self):
+        """Blocks until new email sources arrived, and returns them"""
+        while True:
+            new_sources = self.get_new_sources()
+            if len(new_sources) > 0:
+                return new_sources
+            if self._changed.is_set():
+                # Unsettled emails, or notifications while listing
+                time.sleep(SETTLE_SECONDS / 2)
+            else:
+                self._changed.wait(self.poll_seconds)
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()